@@ -17,4 +17,7 @@ setup(name='spectrumpy',
             'configparser',
             'datetime'
       ],
+      extras_require={
+            'async': ['aiohttp']
+      },
       zip_safe=False)
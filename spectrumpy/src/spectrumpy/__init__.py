@@ -1 +1,34 @@
+import types
+import importlib
 from .spectrumpy import *
+from .cache import *
+from .calllog import *
+from .metrics import *
+from .batch import *
+from .lazy import *
+
+#
+# Modules importing requests, aiohttp or lxml load when one of their names is first used (PEP 562).
+#
+
+LAZY_NAMES = {
+	'Transport':'.transport',
+	'BasicAuthHeader':'.transport',
+	'AsyncTransport':'.asyncclient',
+	'AsyncSpectrumServices':'.asyncclient',
+	'WadlParser':'.wadl',
+	'ParseServiceIndex':'.wadl'
+}
+
+def __getattr__(name):
+	module = LAZY_NAMES.get(name)
+	if module is None:
+		raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+	value = getattr(importlib.import_module(module, __name__), name)
+	globals()[name] = value
+	return value
+
+def __dir__():
+	return sorted(set(globals()) | set(LAZY_NAMES))
+
+__all__ = [name for name, value in globals().items() if not name.startswith('_') and not isinstance(value, (types.ModuleType, LazyImport))] + list(LAZY_NAMES)
@@ -0,0 +1,146 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import time
+import asyncio
+from .transport import BasicAuthHeader
+from .metrics import CallMetrics, ServiceName
+from .spectrumpy import Error
+
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
+
+__all__ = ['AsyncTransport', 'AsyncSpectrumServices']
+
+class AsyncTransport:
+	"""Pooled asyncio HTTP transport with a per-server limit on requests in flight. """
+
+	def __init__(self, credentials = None, concurrency = 100, limitPerHost = 100, timeout = 300, metrics = None):
+		''' Constructor for this class. Calls are recorded in metrics, None uses the process wide CallMetrics. '''
+		if aiohttp is None:
+			raise ImportError('The asyncio client requires aiohttp, install it with: pip install spectrumpy[async]')
+		self.concurrency = concurrency
+		self.limitPerHost = limitPerHost
+		self.timeout = timeout
+		self.metrics = CallMetrics.Default() if metrics is None else metrics
+		self.headers = {}
+		if credentials is not None:
+			self.headers['Authorization'] = BasicAuthHeader(credentials[0], credentials[1])
+		self.session = None
+		self.semaphore = None
+		self.loop = None
+
+	def __Session(self):
+
+		#
+		# Sessions are bound to the event loop that opened them and must be closed in it, a later loop opens a new one.
+		#
+
+		loop = asyncio.get_running_loop()
+		if self.session is not None and not self.session.closed and self.loop is not loop:
+			raise RuntimeError('The async transport is still open in another event loop, await its close() before that loop ends')
+		if self.session is None or self.session.closed:
+			connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.limitPerHost)
+			self.session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=aiohttp.ClientTimeout(total=self.timeout))
+			self.semaphore = asyncio.Semaphore(self.concurrency)
+			self.loop = loop
+		return self.session
+
+	async def request(self, method, url, data = None, headers = None):
+		"""Sends the request over a pooled connection and returns the response content. """
+		session = self.__Session()
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		async with self.semaphore:
+
+			#
+			# Time to first byte is measured once the response headers are in, connect time is part of it.
+			#
+
+			start = time.perf_counter()
+			headersTime = None
+			try:
+				async with session.request(method, url, data=data, headers=headers) as response:
+					headersTime = time.perf_counter() - start
+					response.raise_for_status()
+					content = await response.read()
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				self.metrics.Record(ServiceName(url), {'ttfb':headersTime, 'total':time.perf_counter() - start}, 0 if data is None else len(data), error=str(e) or type(e).__name__, url=url)
+				raise
+			total = time.perf_counter() - start
+			self.metrics.Record(ServiceName(url), {'ttfb':headersTime, 'download':total - headersTime, 'total':total}, 0 if data is None else len(data), len(content), url=url)
+			return content
+
+	async def close(self):
+		"""Closes all pooled connections. Must be awaited in the event loop that made the requests before it ends, the transport
+		can be used again afterwards, also from another loop. """
+		if self.session is not None and not self.session.closed:
+			await self.session.close()
+		self.session = None
+		self.loop = None
+
+class AsyncSpectrumServices:
+	"""Asyncio mirror of SpectrumServices: await services.MyFlow(**kwargs). Its connections belong to the event loop that uses
+	them, use it as 'async with services:' or await close() before that loop ends, e.g. at the end of the asyncio.run main. """
+
+	def __init__(self, server, transport):
+		''' Constructor for this class. '''
+		self.server = server
+		self.transport = transport
+		self.debug = server.debug
+
+	def __getattr__(self, service):
+		if service.startswith('_'):
+			raise AttributeError(service)
+		async def api(*args, **kwargs):
+			return await self.Call(service, **kwargs)
+		return api
+
+	async def Binding(self, service):
+		"""Returns the compiled binding for the service, compiling it in a worker thread on first use. """
+		binding = self.server.bindings.get((service, 'results_json_GET'))
+		if binding is None:
+			loop = asyncio.get_running_loop()
+			binding = await loop.run_in_executor(None, self.server.GetServiceBinding, service)
+		return binding
+
+	async def Call(self, service, **kwargs):
+		"""Calls the service with the supplied arguments and returns the decoded response. """
+		binding = await self.Binding(service)
+		if binding is None:
+			raise KeyError('Unknown Spectrum service: {0}'.format(service))
+		url, data = binding.Encode(kwargs)
+		headers = {'Content-Type': binding.ContentType, 'Accept': binding.ContentType}
+		if (self.debug == True):
+			print ('Request URL: {0}'.format(url))
+		try:
+			response = await self.transport.request(binding.RequestType.upper(), url, data, headers)
+		except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+			Error('REST API ERROR: {0}\n{1}'.format(e, url))
+			return None
+		response = response.decode('utf-8')
+		if (self.debug == True):
+			print (response)
+		return response
+
+	async def close(self):
+		"""Closes the pooled connections of this client, await it before the event loop ends. """
+		await self.transport.close()
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
@@ -0,0 +1,166 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+__all__ = ['BatchRun', 'BatchResult', 'BatchProgress', 'IterRows']
+
+def IterRows(rows):
+	"""Yields (index, kwargs dict) pairs from a pandas DataFrame or an iterable of dicts. """
+
+	#
+	# Stream DataFrame rows as dicts without materializing every record up front.
+	#
+
+	if hasattr(rows, 'itertuples') and hasattr(rows, 'columns'):
+		columns = list(rows.columns)
+		for index, values in zip(rows.index, rows.itertuples(index=False, name=None)):
+			yield index, dict(zip(columns, values))
+	else:
+		for index, row in enumerate(rows):
+			yield index, row
+
+class BatchResult:
+	"""The outcome of one input row: its index, the input kwargs, the output or the captured error. """
+
+	__slots__ = ('index', 'input', 'output', 'error')
+
+	def __init__(self, index, input, output = None, error = None):
+		self.index = index
+		self.input = input
+		self.output = output
+		self.error = error
+
+	def ok(self):
+		"""Indicates True/False if the row was processed without error. """
+		return self.error is None
+
+	def __repr__(self):
+		return 'BatchResult(index={0!r}, output={1!r}, error={2!r})'.format(self.index, self.output, self.error)
+
+class BatchProgress:
+	"""Thread safe progress and throughput counters of a BatchRun. """
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.submitted = 0
+		self.completed = 0
+		self.failed = 0
+		self.startTime = None
+		self.endTime = None
+
+	def Elapsed(self):
+		"""Returns the seconds since the first row was submitted. """
+		if self.startTime is None:
+			return 0.0
+		return (time.perf_counter() if self.endTime is None else self.endTime) - self.startTime
+
+	def Throughput(self):
+		"""Returns completed rows per second. """
+		elapsed = self.Elapsed()
+		return self.completed / elapsed if elapsed > 0 else 0.0
+
+	def Snapshot(self):
+		"""Returns the counters as a dict. """
+		with self.lock:
+			return {'submitted':self.submitted, 'completed':self.completed, 'failed':self.failed, 'inFlight':self.submitted - self.completed,
+				'elapsed':self.Elapsed(), 'rowsPerSecond':self.Throughput()}
+
+class BatchRun:
+	"""Runs a function over rows on a bounded thread pool. Iterate it for BatchResults or call ToDataFrame(). """
+
+	def __init__(self, function, rows, workers = 8, ordered = True, progress = None):
+		''' Constructor for this class. rows is a pandas DataFrame or an iterable of kwargs dicts. '''
+		self.function = function
+		self.rows = rows
+		self.workers = workers
+		self.ordered = ordered
+		self.callback = progress
+		self.Progress = BatchProgress()
+		self.started = False
+
+	def __Run(self, index, row):
+		try:
+			return BatchResult(index, row, output=self.function(row))
+		except Exception as e:
+			return BatchResult(index, row, error=e)
+
+	def __Completed(self, result):
+		with self.Progress.lock:
+			self.Progress.completed += 1
+			if result.error is not None:
+				self.Progress.failed += 1
+		if self.callback is not None:
+			self.callback(self.Progress)
+		return result
+
+	def __iter__(self):
+		if self.started:
+			raise RuntimeError('A BatchRun can only be iterated once')
+		self.started = True
+		self.Progress.startTime = time.perf_counter()
+
+		#
+		# Keep at most two rows per worker queued so large inputs are never submitted all at once.
+		#
+
+		maxPending = self.workers * 2
+		pending = collections.deque()
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			try:
+				for index, row in IterRows(self.rows):
+					pending.append(executor.submit(self.__Run, index, row))
+					with self.Progress.lock:
+						self.Progress.submitted += 1
+					while len(pending) >= maxPending:
+						for result in self.__Drain(pending):
+							yield result
+				while len(pending) > 0:
+					for result in self.__Drain(pending):
+						yield result
+			finally:
+				for future in pending:
+					future.cancel()
+				self.Progress.endTime = time.perf_counter()
+
+	def __Drain(self, pending):
+		if self.ordered:
+			pending[0].result()
+			while len(pending) > 0 and pending[0].done():
+				yield self.__Completed(pending.popleft().result())
+		else:
+			done, notDone = wait(pending, return_when=FIRST_COMPLETED)
+			for future in list(pending):
+				if future in done:
+					pending.remove(future)
+					yield self.__Completed(future.result())
+
+	def Results(self):
+		"""Returns all BatchResults as a list. """
+		return list(self)
+
+	def ToDataFrame(self):
+		"""Runs the batch and returns a pandas DataFrame of the inputs with 'output' and 'error' columns. """
+		import pandas as pd
+		indexes = []
+		records = []
+		for result in self:
+			record = dict(result.input)
+			record['output'] = result.output
+			record['error'] = None if result.error is None else str(result.error)
+			indexes.append(result.index)
+			records.append(record)
+		return pd.DataFrame(records, index=indexes)
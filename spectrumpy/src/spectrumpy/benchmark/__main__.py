@@ -0,0 +1,84 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import os
+import sys
+import argparse
+import tempfile
+from .suite import BenchmarkSuite, SaveResults, LoadResults, CompareResults, CheckImportBudget, IMPORT_BUDGET
+from ..calllog import CallLog
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(prog='python -m spectrumpy.benchmark', description='Benchmarks spectrumpy against an in-process mock Spectrum server.')
+	parser.add_argument('--output', help='write the results JSON to this file')
+	parser.add_argument('--compare', help='compare with a baseline results JSON, exits with 1 on a regression')
+	parser.add_argument('--threshold', type=float, default=0.10, help='relative change of the median counted as a regression (default 0.10)')
+	parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET,
+		help='median seconds allowed for importing a package, exits with 1 when exceeded or when the import loads a heavy dependency (default {0})'.format(IMPORT_BUDGET))
+	parser.add_argument('--only', nargs='*', choices=BenchmarkSuite.BENCHMARKS, help='benchmarks to run')
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--warmup', type=int, default=1)
+	parser.add_argument('--calls', type=int, default=200)
+	parser.add_argument('--rows', type=int, default=2000)
+	parser.add_argument('--workers', type=int, default=8)
+	parser.add_argument('--features', type=int, default=10000)
+	parser.add_argument('--page-length', type=int, default=1000)
+	parser.add_argument('--geometry', default='Polygon', choices=['Point', 'LineString', 'Polygon', 'MultiPolygon'])
+	parser.add_argument('--vertices', type=int, default=16)
+	parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every mock server response')
+	parser.add_argument('--grammar-types', type=int, default=2000, help='complex types in the grammar of the wadl_parse benchmark')
+	args = parser.parse_args(argv)
+
+	suite = BenchmarkSuite(repeat=args.repeat, warmup=args.warmup, calls=args.calls, rows=args.rows, workers=args.workers, features=args.features,
+		pageLength=args.page_length, geometryType=args.geometry, vertices=args.vertices, latency=args.latency,
+		grammarTypes=args.grammar_types)
+
+	def progress(name, measure):
+		if measure.get('skipped'):
+			print ('{0:<24} skipped'.format(name))
+		else:
+			print ('{0:<24} median {1:9.4f}s  min {2:9.4f}s  p95 {3:9.4f}s  {4:12.1f} items/s'.format(name, measure['median'], measure['min'], measure['p95'], measure['itemsPerSecond'])
+				+ ('  peak {0:.1f} MB'.format(measure['peakBytes'] / 1048576.0) if 'peakBytes' in measure else ''))
+
+	#
+	# Run in a scratch directory so call logs and caches of the run do not end up in the working directory.
+	#
+
+	cwd = os.getcwd()
+	with tempfile.TemporaryDirectory() as scratch:
+		os.chdir(scratch)
+		try:
+			results = suite.Run(args.only, progress)
+			CallLog.ForPath('CallLog.txt').Flush()
+		finally:
+			os.chdir(cwd)
+
+	if args.output:
+		SaveResults(results, args.output)
+	status = 0
+	for message in CheckImportBudget(results, args.import_budget):
+		print ('IMPORT BUDGET: {0}'.format(message))
+		status = 1
+	if args.compare:
+		regressions = 0
+		for name, before, after, change, verdict in CompareResults(LoadResults(args.compare), results, args.threshold):
+			if verdict == 'differs':
+				print ('WARNING: benchmark config differs from the baseline')
+				continue
+			print ('{0:<24} {1:9.4f}s -> {2:9.4f}s  {3:+7.1%}  {4}'.format(name, before, after, change, verdict))
+			regressions += verdict == 'regression'
+		return 1 if regressions > 0 else status
+	return status
+
+if __name__ == '__main__':
+	sys.exit(main())
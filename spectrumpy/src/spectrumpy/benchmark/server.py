@@ -0,0 +1,317 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import re
+import json
+import math
+import time
+import threading
+import collections
+import http.server
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+
+__all__ = ['MockSpectrumServer']
+
+WADL = '''<?xml version="1.0" encoding="UTF-8"?>
+<application xmlns="http://wadl.dev.java.net/2009/02" xmlns:xs="http://www.w3.org/2001/XMLSchema">
+<grammars><include href="{name}?_xsd=1"/></grammars>
+<resources base="{base}rest/{name}/">
+<resource path="/">
+<resource path="results.json">
+<method name="GET"><request>
+<param name="Data.AddressLine1" style="query" type="xs:string"/>
+<param name="Data.City" style="query" type="xs:string"/>
+<param name="Data.PostalCode" style="query" type="xs:string"/>
+<param name="Option.Mode" style="query" type="xs:string"/>
+</request><response><representation mediaType="application/json"/></response></method>
+</resource>
+<resource path="results.xml">
+<method name="POST"><request><representation mediaType="application/xml" element="{name}Request"/></request>
+<response><representation mediaType="application/xml" element="{name}Response"/></response></method>
+</resource>
+</resource>
+</resources>
+</application>'''
+
+XSD = '''<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="http://www.pb.com/spectrum/services/{name}">
+<xs:element name="{name}Request" type="tns:{name}Request"/>
+<xs:complexType name="{name}Request"><xs:sequence>
+<xs:element name="options" type="tns:options" minOccurs="0"/>
+<xs:element name="Input" type="tns:Input"/>
+</xs:sequence></xs:complexType>
+<xs:complexType name="options"><xs:sequence><xs:element name="Mode" type="xs:string" minOccurs="0"/></xs:sequence></xs:complexType>
+<xs:complexType name="Input"><xs:sequence><xs:element name="Row" type="tns:InputRow" maxOccurs="unbounded"/></xs:sequence></xs:complexType>
+<xs:complexType name="BaseRow"><xs:sequence><xs:element name="user_fields" type="xs:string" minOccurs="0"/></xs:sequence><xs:attribute name="id" type="xs:string"/></xs:complexType>
+<xs:complexType name="InputRow"><xs:complexContent><xs:extension base="tns:BaseRow"><xs:sequence>
+<xs:element name="AddressLine1" type="xs:string" minOccurs="0"/>
+<xs:element name="City" type="xs:string" minOccurs="0"/>
+<xs:element name="PostalCode" type="xs:string" minOccurs="0"/>
+</xs:sequence></xs:extension></xs:complexContent></xs:complexType>
+<xs:element name="{name}Response" type="tns:{name}Response"/>
+<xs:complexType name="{name}Response"><xs:sequence><xs:element name="Output" type="tns:Output"/></xs:sequence></xs:complexType>
+<xs:complexType name="Output"><xs:sequence><xs:element name="Row" type="tns:OutputRow" maxOccurs="unbounded"/></xs:sequence></xs:complexType>
+<xs:complexType name="OutputRow"><xs:sequence>
+<xs:element name="AddressLine1" type="xs:string" minOccurs="0"/>
+<xs:element name="City" type="xs:string" minOccurs="0"/>
+<xs:element name="PostalCode" type="xs:string" minOccurs="0"/>
+<xs:element name="Status" type="xs:string" minOccurs="0"/>
+</xs:sequence></xs:complexType>
+</xs:schema>'''
+
+NAMED_RESOURCE_WSDL = '''<?xml version="1.0" encoding="UTF-8"?>
+<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+	xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="http://www.mapinfo.com/midev/service/namedresource/v1"
+	targetNamespace="http://www.mapinfo.com/midev/service/namedresource/v1">
+<wsdl:types>
+<xs:schema targetNamespace="http://www.mapinfo.com/midev/service/namedresource/v1" elementFormDefault="qualified">
+<xs:complexType name="NamedResource"><xs:sequence>
+<xs:element name="Path" type="xs:string"/>
+<xs:element name="Type" type="xs:string" minOccurs="0"/>
+</xs:sequence></xs:complexType>
+<xs:element name="ListNamedResourcesRequest"><xs:complexType><xs:sequence><xs:element name="Path" type="xs:string"/></xs:sequence></xs:complexType></xs:element>
+<xs:element name="ListNamedResourcesResponse"><xs:complexType><xs:sequence>
+<xs:element name="NamedResource" type="tns:NamedResource" minOccurs="0" maxOccurs="unbounded"/>
+<xs:element name="Locale" type="xs:string" minOccurs="0"/>
+</xs:sequence></xs:complexType></xs:element>
+<xs:element name="AddNamedResourceRequest"><xs:complexType><xs:sequence>
+<xs:element name="Resource"><xs:complexType><xs:sequence><xs:any namespace="##any" processContents="lax"/></xs:sequence></xs:complexType></xs:element><xs:element name="Path" type="xs:string"/>
+</xs:sequence></xs:complexType></xs:element>
+<xs:element name="AddNamedResourceResponse"><xs:complexType><xs:sequence/></xs:complexType></xs:element>
+<xs:element name="UpdateNamedResourceRequest"><xs:complexType><xs:sequence>
+<xs:element name="Resource"><xs:complexType><xs:sequence><xs:any namespace="##any" processContents="lax"/></xs:sequence></xs:complexType></xs:element><xs:element name="Path" type="xs:string"/>
+</xs:sequence></xs:complexType></xs:element>
+<xs:element name="UpdateNamedResourceResponse"><xs:complexType><xs:sequence/></xs:complexType></xs:element>
+</xs:schema>
+</wsdl:types>
+{messages}
+<wsdl:portType name="NamedResourceServiceInterface">{portOperations}</wsdl:portType>
+<wsdl:binding name="NamedResourceServiceBinding" type="tns:NamedResourceServiceInterface">
+<soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>{bindingOperations}
+</wsdl:binding>
+<wsdl:service name="NamedResourceService">
+<wsdl:port name="NamedResourceServicePort" binding="tns:NamedResourceServiceBinding"><soap:address location="{base}soap/NamedResourceService"/></wsdl:port>
+</wsdl:service>
+</wsdl:definitions>'''
+
+SOAP_OPERATIONS = {'listNamedResources':'ListNamedResources', 'addNamedResource':'AddNamedResource', 'updateNamedResource':'UpdateNamedResource'}
+
+def NamedResourceWsdl(base):
+	"""Returns the document/literal WSDL of the stand-in NamedResourceService. """
+	messages = ''
+	portOperations = ''
+	bindingOperations = ''
+	for operation, element in SOAP_OPERATIONS.items():
+		messages += ('<wsdl:message name="{0}Request"><wsdl:part name="parameters" element="tns:{0}Request"/></wsdl:message>'
+			'<wsdl:message name="{0}Response"><wsdl:part name="parameters" element="tns:{0}Response"/></wsdl:message>').format(element)
+		portOperations += ('<wsdl:operation name="{0}"><wsdl:input message="tns:{1}Request"/><wsdl:output message="tns:{1}Response"/></wsdl:operation>').format(operation, element)
+		bindingOperations += ('<wsdl:operation name="{0}"><soap:operation soapAction="{0}"/><wsdl:input><soap:body use="literal"/></wsdl:input>'
+			'<wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>').format(operation)
+	return NAMED_RESOURCE_WSDL.format(base=base, messages=messages, portOperations=portOperations, bindingOperations=bindingOperations)
+
+class MockSpectrumServer:
+	"""In-process stand-in for a Spectrum server: the /rest service index, WADL and grammar includes, dataflow JSON and XML responses,
+	FeatureService features.json pages and the NamedResourceService SOAP endpoint. Use it as a context manager or call Start()/Stop(). """
+
+	def __init__(self, services = ('ValidateAddress', 'Geocode'), featureCount = 10000, geometryType = 'Polygon', vertices = 16, properties = 8, latency = 0.0):
+		''' Constructor for this class. geometryType is Point, LineString, Polygon or MultiPolygon, vertices is the coordinates per ring or line.
+		latency adds that many seconds to every response. '''
+		self.services = list(services)
+		self.featureCount = featureCount
+		self.geometryType = geometryType
+		self.vertices = vertices
+		self.properties = properties
+		self.latency = latency
+		self.resources = {}
+		self.requests = collections.Counter()
+		self.connections = 0
+		self.lock = threading.Lock()
+		self.pages = {}
+		self.httpd = None
+		self.thread = None
+		self.url = None
+
+	def Start(self):
+		"""Starts serving on a free local port and returns the base URL. """
+		server = self
+		class Handler(MockSpectrumHandler):
+			mock = server
+		class HTTPServer(http.server.ThreadingHTTPServer):
+			daemon_threads = True
+			def get_request(self):
+				with server.lock:
+					server.connections += 1
+				return super().get_request()
+		self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+		self.thread = threading.Thread(target=self.httpd.serve_forever, name='spectrumpy-mock-server', daemon=True)
+		self.thread.start()
+		self.url = 'http://127.0.0.1:{0}/'.format(self.httpd.server_address[1])
+		return self.url
+
+	def Stop(self):
+		"""Stops serving. """
+		if self.httpd is not None:
+			self.httpd.shutdown()
+			self.httpd.server_close()
+			self.httpd = None
+
+	def __enter__(self):
+		self.Start()
+		return self
+
+	def __exit__(self, *exc):
+		self.Stop()
+
+	def Count(self, kind):
+		with self.lock:
+			self.requests[kind] += 1
+
+	def Geometry(self, id):
+		"""Returns the GeoJSON geometry of a feature, deterministic for the id. """
+		x = (id % 360) - 180.0
+		y = ((id // 360) % 170) - 85.0
+		if self.geometryType == 'Point':
+			return {'type':'Point', 'coordinates':[x + 0.5, y + 0.5]}
+		steps = max(self.vertices, 4)
+		ring = [[round(x + 0.5 + 0.4 * math.cos(2 * math.pi * i / (steps - 1)), 6), round(y + 0.5 + 0.4 * math.sin(2 * math.pi * i / (steps - 1)), 6)] for i in range(steps - 1)]
+		if self.geometryType == 'LineString':
+			return {'type':'LineString', 'coordinates':ring}
+		ring.append(ring[0])
+		if self.geometryType == 'MultiPolygon':
+			return {'type':'MultiPolygon', 'coordinates':[[ring], [[[c[0], c[1] + 0.05] for c in ring]]]}
+		return {'type':'Polygon', 'coordinates':[ring]}
+
+	def FeaturePage(self, pageLength, page):
+		"""Returns the encoded features.json page, pages are generated once and reused. """
+		key = (pageLength, page)
+		with self.lock:
+			body = self.pages.get(key)
+		if body is not None:
+			return body
+		start = (page - 1) * pageLength if pageLength else 0
+		count = max(0, min(pageLength if pageLength else self.featureCount, self.featureCount - start))
+		features = []
+		for id in range(start, start + count):
+			properties = {'id':id, 'name':'Feature {0}'.format(id), 'value':float(id % 1000)}
+			for i in range(3, self.properties):
+				properties['p{0}'.format(i)] = (id * i) % 97
+			features.append({'type':'Feature', 'properties':properties, 'geometry':self.Geometry(id)})
+		body = json.dumps({'type':'FeatureCollection', 'features':features}).encode('utf-8')
+		with self.lock:
+			if len(self.pages) >= 256:
+				self.pages.clear()
+			self.pages[key] = body
+		return body
+
+class MockSpectrumHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# Headers and body are written separately, without TCP_NODELAY delayed acknowledgements would dominate every call
+	disable_nagle_algorithm = True
+	mock = None
+
+	def log_message(self, *args):
+		pass
+
+	def Send(self, body, contentType = 'application/xml', status = 200):
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+		if self.mock.latency > 0:
+			time.sleep(self.mock.latency)
+		self.send_response(status)
+		self.send_header('Content-Type', contentType)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		parts = urlsplit(self.path)
+		query = parse_qs(parts.query, keep_blank_values=True)
+		base = 'http://{0}/'.format(self.headers['Host'])
+		path = parts.path
+
+		if path == '/rest' or path == '/rest/':
+			self.mock.Count('index')
+			links = ''.join(['<li><a href="{0}rest/{1}?_wadl">{0}rest/{1}?_wadl</a></li>'.format(base, name) for name in self.mock.services])
+			return self.Send('<html><head><title>Services</title></head><body><ul>' + links + '</ul></body></html>', 'text/html')
+
+		match = re.match(r'^/rest/(\w+)$', path)
+		if match and match.group(1) in self.mock.services:
+			if '_wadl' in query:
+				self.mock.Count('wadl')
+				return self.Send(WADL.format(base=base, name=match.group(1)))
+			if '_xsd' in query:
+				self.mock.Count('xsd')
+				return self.Send(XSD.format(name=match.group(1)))
+
+		match = re.match(r'^/rest/(\w+)/results\.json$', path)
+		if match and match.group(1) in self.mock.services:
+			self.mock.Count('results')
+			row = {key.split('.', 1)[-1]:values[0] for key, values in query.items() if key.startswith('Data.')}
+			row['Status'] = 'OK'
+			return self.Send(json.dumps({'Output':[row]}), 'application/json')
+
+		if path.endswith('/FeatureService/tables/features.json'):
+			self.mock.Count('features')
+			pageLength = int(query.get('pageLength', ['0'])[0] or 0)
+			page = int(query.get('page', ['1'])[0] or 1)
+			return self.Send(self.mock.FeaturePage(pageLength, page), 'application/json')
+
+		if path.endswith('/FeatureService/listTableNames.json'):
+			self.mock.Count('tables')
+			return self.Send(json.dumps({'Response':['/Samples/NamedTables/Features']}), 'application/json')
+
+		if path == '/soap/NamedResourceService' and 'wsdl' in query:
+			self.mock.Count('wsdl')
+			return self.Send(NamedResourceWsdl(base), 'text/xml')
+
+		self.Send('Not Found', 'text/plain', 404)
+
+	def do_POST(self):
+		path = urlsplit(self.path).path
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+		match = re.match(r'^/rest/(\w+)/results\.xml$', path)
+		if match and match.group(1) in self.mock.services:
+			self.mock.Count('batch')
+			name = match.group(1).encode('utf-8')
+			rows = re.findall(rb'<Row[^>]*>(.*?)</Row>', body, re.S)
+			output = b''.join([b'<Row>' + row + b'<Status>OK</Status></Row>' for row in rows])
+			return self.Send(b'<?xml version="1.0"?><' + name + b'Response><Output>' + output + b'</Output></' + name + b'Response>')
+
+		if path == '/soap/NamedResourceService':
+			return self.Soap(body)
+
+		self.Send('Not Found', 'text/plain', 404)
+
+	def Soap(self, body):
+		match = re.search(rb'<(?:\w+:)?(ListNamedResources|AddNamedResource|UpdateNamedResource)Request\b', body)
+		if match is None:
+			return self.Send('Unknown operation', 'text/plain', 500)
+		operation = match.group(1).decode('utf-8')
+		self.mock.Count('soap.' + operation)
+		path = re.findall(rb'<(?:\w+:)?Path>(.*?)</(?:\w+:)?Path>', body, re.S)
+		path = path[-1].decode('utf-8') if len(path) > 0 else ''
+		content = ''
+		if operation == 'ListNamedResources':
+			with self.mock.lock:
+				paths = sorted([name for name in self.mock.resources if name.startswith(path)])
+			content = ''.join(['<tns:NamedResource><tns:Path>{0}</tns:Path><tns:Type>{1}</tns:Type></tns:NamedResource>'.format(escape(name), self.mock.resources[name])
+				for name in paths])
+		else:
+			kind = re.search(rb'<(?:\w+:)?Resource\b[^>]*>\s*<(?:\w+:)?(\w+)', body)
+			with self.mock.lock:
+				self.mock.resources[path] = kind.group(1).decode('utf-8') if kind else 'Resource'
+		envelope = ('<?xml version="1.0" encoding="UTF-8"?><soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+			'xmlns:tns="http://www.mapinfo.com/midev/service/namedresource/v1"><soapenv:Body><tns:{0}Response>{1}</tns:{0}Response></soapenv:Body></soapenv:Envelope>').format(operation, content)
+		self.Send(envelope, 'text/xml')
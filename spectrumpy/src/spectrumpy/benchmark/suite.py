@@ -0,0 +1,333 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import subprocess
+import importlib.util
+import statistics
+import tracemalloc
+from datetime import datetime
+from .server import MockSpectrumServer
+
+__all__ = ['BenchmarkSuite', 'Measure', 'LoadResults', 'SaveResults', 'CompareResults', 'ImportProbe', 'CheckImportBudget', 'RESULTS_VERSION',
+	'HEAVY_MODULES', 'IMPORT_BUDGET']
+
+# Version of the results file format
+RESULTS_VERSION = 1
+
+# Dependencies the packages load on first use, importing spectrumpy or spectrumspatialpy must not load them
+HEAVY_MODULES = ('requests', 'urllib3', 'zeep', 'lxml.etree', 'aiohttp', 'xml.dom.minidom', 'numpy', 'pandas', 'geopandas', 'shapely', 'colour', 'pyarrow')
+
+# Median seconds allowed for importing a package in a fresh interpreter
+IMPORT_BUDGET = 0.5
+
+def Measure(function, repeat = 5, warmup = 1, items = 1, memory = False):
+	"""Times function() repeat times after warmup runs. items is the work per run (calls, rows, features) used for the throughput.
+	With memory, one more run is traced and its peak of Python allocations is reported as peakBytes. """
+	for i in range(warmup):
+		function()
+	samples = []
+	for i in range(repeat):
+		gc.collect()
+		start = time.perf_counter()
+		function()
+		samples.append(time.perf_counter() - start)
+	measure = Summarize(samples, items)
+	if memory:
+		gc.collect()
+		tracemalloc.start()
+		try:
+			function()
+			measure['peakBytes'] = tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+	return measure
+
+def Summarize(samples, items = 1):
+	"""Returns the statistics of a Measure for timing samples in seconds. """
+	median = statistics.median(samples)
+	ordered = sorted(samples)
+	return {
+		'repeat':len(samples),
+		'items':items,
+		'min':ordered[0],
+		'median':median,
+		'mean':statistics.mean(samples),
+		'max':ordered[-1],
+		'p95':ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+		'stdev':statistics.stdev(samples) if len(samples) > 1 else 0.0,
+		'itemsPerSecond':items / median if median > 0 else None,
+		'samples':samples
+	}
+
+def ImportProbe(module):
+	"""Imports the module in a fresh interpreter on this sys.path. Returns the seconds the import took and the HEAVY_MODULES it loaded. """
+	code = '\n'.join([
+		'import sys, time, json',
+		'start = time.perf_counter()',
+		'import {0}'.format(module),
+		'seconds = time.perf_counter() - start',
+		'print(json.dumps([seconds, [name for name in {0!r} if name in sys.modules]]))'.format(HEAVY_MODULES)])
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join([path for path in sys.path if path])
+	output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, env=env, check=True).stdout
+	seconds, loaded = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+	return seconds, loaded
+
+def CheckImportBudget(results, budget = IMPORT_BUDGET):
+	"""Returns a message for each import benchmark of a results document over the budget or loading a heavy dependency. """
+	messages = []
+	for name, measure in results['benchmarks'].items():
+		if not name.startswith('import_') or measure.get('skipped'):
+			continue
+		if measure['median'] > budget:
+			messages.append('{0} takes {1:.3f}s, over the budget of {2:.3f}s'.format(name, measure['median'], budget))
+		if measure.get('heavyModules'):
+			messages.append('{0} loads {1}'.format(name, ', '.join(measure['heavyModules'])))
+	return messages
+
+def WadlDocuments(types, elements = 10, methods = 20):
+	"""Returns a synthetic Spectrum WADL and its XSD grammar with the given number of complex types, for parser benchmarks. """
+	wadl = ['<?xml version="1.0" encoding="UTF-8"?>',
+		'<application xmlns="http://wadl.dev.java.net/2009/02" xmlns:ns2="http://wadl.dev.java.net/2009/02" xmlns:xs="http://www.w3.org/2001/XMLSchema">',
+		'<grammars><include href="Large?_xsd=1"/></grammars><resources base="http://localhost:8080/rest/Large/"><resource path="/">']
+	for method in range(methods):
+		wadl.append('<resource path="results{0}.json"><method name="GET"><request>'.format(method))
+		wadl.extend(['<param name="Data.Field{0}" style="query" type="xs:string"/>'.format(i) for i in range(elements)])
+		wadl.append('</request><response><ns2:representation mediaType="application/json"/></response></method></resource>')
+		wadl.append('<resource path="results{0}.xml"><method name="POST"><request><ns2:representation mediaType="application/xml" element="T0"/></request>'.format(method))
+		wadl.append('<response><ns2:representation mediaType="application/xml" element="T1"/></response></method></resource>')
+	wadl.append('</resource></resources></application>')
+	xsd = ['<?xml version="1.0" encoding="UTF-8"?>', '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="http://www.pb.com/spectrum/services/Large">']
+	for index in range(types):
+		xsd.append('<xs:complexType name="T{0}">'.format(index))
+		# Every tenth type is a base, the others extend it
+		if index % 10 != 0:
+			xsd.append('<xs:complexContent><xs:extension base="tns:T{0}">'.format(index - index % 10))
+		xsd.append('<xs:sequence>')
+		xsd.extend(['<xs:element name="F{0}" type="xs:string" minOccurs="0"{1}/>'.format(i, ' maxOccurs="unbounded"' if i == 0 else '') for i in range(elements)])
+		xsd.append('</xs:sequence><xs:attribute name="id{0}" type="xs:string"/>'.format(index))
+		if index % 10 != 0:
+			xsd.append('</xs:extension></xs:complexContent>')
+		xsd.append('</xs:complexType>')
+	xsd.append('</xs:schema>')
+	return '\n'.join(wadl).encode('utf-8'), '\n'.join(xsd).encode('utf-8')
+
+class BenchmarkSuite:
+	"""Repeatable benchmarks of discovery, single call latency, batch throughput, feature paging and GeoDataFrame conversion
+	against a MockSpectrumServer. Feature benchmarks require spectrumspatialpy and are skipped without it. """
+
+	BENCHMARKS = ('discovery_cold', 'discovery_warm', 'single_call', 'batch_map', 'batch_xml', 'feature_paging', 'geodataframe', 'named_resource_upsert',
+		'wadl_parse', 'import_spectrumpy', 'import_spectrumspatialpy')
+
+	def __init__(self, repeat = 5, warmup = 1, calls = 200, rows = 2000, workers = 8, features = 10000, pageLength = 1000,
+		geometryType = 'Polygon', vertices = 16, latency = 0.0, grammarTypes = 2000):
+		''' Constructor for this class. '''
+		self.repeat = repeat
+		self.warmup = warmup
+		self.calls = calls
+		self.rows = rows
+		self.workers = workers
+		self.features = features
+		self.pageLength = pageLength
+		self.geometryType = geometryType
+		self.vertices = vertices
+		self.latency = latency
+		self.grammarTypes = grammarTypes
+		self.server = None
+		self.url = None
+		self.credentials = ('admin', 'admin')
+
+	def Config(self):
+		"""Returns the suite parameters, results are only comparable between runs with the same config. """
+		return {'repeat':self.repeat, 'warmup':self.warmup, 'calls':self.calls, 'rows':self.rows, 'workers':self.workers, 'features':self.features,
+			'pageLength':self.pageLength, 'geometryType':self.geometryType, 'vertices':self.vertices, 'latency':self.latency,
+			'grammarTypes':self.grammarTypes}
+
+	def __Server(self, cache = None):
+		import spectrumpy
+		from spectrumpy.cache import WadlCache
+		return spectrumpy.Server(self.url, self.credentials, wadlCache=WadlCache() if cache is None else cache)
+
+	def __Spatial(self):
+		try:
+			import spectrumspatialpy
+		except ImportError:
+			return None
+		return spectrumspatialpy.SpatialServer(self.__Server())
+
+	#
+	# Benchmarks, each returns the Measure of one scenario or None when it cannot run here.
+	#
+
+	def __Discover(self, cache = None):
+		server = self.__Server(cache)
+		for service in server.SpectrumServices().Apis:
+			server.GetServiceBinding(service)
+
+	def discovery_cold(self):
+		def run():
+			self.__Discover()
+		return Measure(run, self.repeat, self.warmup)
+
+	def discovery_warm(self):
+		from spectrumpy.cache import WadlCache
+		cache = WadlCache()
+		def run():
+			self.__Discover(cache)
+		return Measure(run, self.repeat, self.warmup)
+
+	def single_call(self):
+		services = self.__Server().SpectrumServices()
+		def run():
+			for i in range(self.calls):
+				services.ValidateAddress(Data_AddressLine1='{0} Main St'.format(i), Data_City='Troy')
+		return Measure(run, self.repeat, self.warmup, self.calls)
+
+	def batch_map(self):
+		services = self.__Server().SpectrumServices()
+		rows = [{'Data_AddressLine1':'{0} Main St'.format(i), 'Data_City':'Troy'} for i in range(self.rows)]
+		def run():
+			for result in services.map('ValidateAddress', rows, workers=self.workers):
+				pass
+		return Measure(run, self.repeat, self.warmup, self.rows)
+
+	def batch_xml(self):
+		services = self.__Server().SpectrumServices()
+		rows = [{'AddressLine1':'{0} Main St'.format(i), 'City':'Troy'} for i in range(self.rows)]
+		def run():
+			for result in services.batch('ValidateAddress', rows, workers=self.workers):
+				pass
+		return Measure(run, self.repeat, self.warmup, self.rows)
+
+	def feature_paging(self):
+		spatial = self.__Spatial()
+		if spatial is None:
+			return None
+		featureService = spatial.FeatureService()
+		def run():
+			for page in featureService.query('select * from "/Samples/NamedTables/Features"', pageLength=self.pageLength, prefetch=2):
+				pass
+		return Measure(run, self.repeat, self.warmup, self.features)
+
+	def geodataframe(self):
+		spatial = self.__Spatial()
+		if spatial is None:
+			return None
+		fc = spatial.FeatureService().query('select * from "/Samples/NamedTables/Features"')
+		geometry = spatial.GeometryOperations()
+		def run():
+			geometry.GeoJSON2GeoDataFrame(fc)
+		return Measure(run, self.repeat, self.warmup, len(fc['features']))
+
+	def named_resource_upsert(self):
+		spatial = self.__Spatial()
+		if spatial is None:
+			return None
+		namedResources = spatial.NamedResourceService()
+		resource = '<NamedDataSourceDefinition version="MXP_NamedResource_1_5" xmlns="http://www.mapinfo.com/mxp"><ConnectionSet/></NamedDataSourceDefinition>'
+		count = 20
+		def run():
+			for i in range(count):
+				namedResources.upsert('/Benchmark', 'Table{0}'.format(i), resource)
+		return Measure(run, self.repeat, self.warmup, count)
+
+	def wadl_parse(self):
+		from spectrumpy.wadl import WadlParser
+		wadl, xsd = WadlDocuments(self.grammarTypes)
+		def run():
+			WadlParser('http://localhost:8080/rest/Large?_wadl', lambda url: xsd).Parse(wadl)
+		return Measure(run, self.repeat, self.warmup, self.grammarTypes, memory=True)
+
+	def __Import(self, module):
+		if importlib.util.find_spec(module) is None:
+			return None
+		for i in range(self.warmup):
+			ImportProbe(module)
+		samples = []
+		loaded = set()
+		for i in range(self.repeat):
+			seconds, heavy = ImportProbe(module)
+			samples.append(seconds)
+			loaded.update(heavy)
+		measure = Summarize(samples)
+		measure['heavyModules'] = sorted(loaded)
+		return measure
+
+	def import_spectrumpy(self):
+		return self.__Import('spectrumpy')
+
+	def import_spectrumspatialpy(self):
+		return self.__Import('spectrumspatialpy')
+
+	def Run(self, only = None, progress = None):
+		"""Runs the benchmarks (all, or the names in only) against a fresh mock server and returns the results document. """
+		results = {}
+		self.server = MockSpectrumServer(featureCount=self.features, geometryType=self.geometryType, vertices=self.vertices, latency=self.latency)
+		self.url = self.server.Start()
+		try:
+			for name in self.BENCHMARKS:
+				if only is not None and name not in only:
+					continue
+				measure = getattr(self, name)()
+				if measure is None:
+					results[name] = {'skipped':True}
+				else:
+					results[name] = measure
+				if progress is not None:
+					progress(name, results[name])
+		finally:
+			self.server.Stop()
+		return {'version':RESULTS_VERSION, 'created':datetime.now().isoformat(), 'environment':Environment(), 'config':self.Config(), 'benchmarks':results}
+
+def Environment():
+	"""Returns the interpreter, platform and library versions the results were measured with. """
+	versions = {}
+	for name in ('spectrumpy', 'spectrumspatialpy', 'requests', 'zeep', 'lxml', 'pandas', 'geopandas', 'shapely', 'numpy'):
+		module = sys.modules.get(name)
+		versions[name] = getattr(module, '__version__', None) if module is not None else None
+	return {'python':platform.python_version(), 'implementation':platform.python_implementation(), 'platform':platform.platform(),
+		'machine':platform.machine(), 'cpus':os.cpu_count(), 'versions':versions}
+
+def SaveResults(results, path):
+	"""Writes a results document as JSON. """
+	with open(path, 'w', encoding='utf-8') as file:
+		json.dump(results, file, indent=2)
+
+def LoadResults(path):
+	"""Reads a results document written by SaveResults. """
+	with open(path, 'r', encoding='utf-8') as file:
+		results = json.load(file)
+	if results.get('version') != RESULTS_VERSION:
+		raise ValueError('Unsupported benchmark results version {0} in {1}'.format(results.get('version'), path))
+	return results
+
+def CompareResults(baseline, current, threshold = 0.10):
+	"""Compares the median times of two results documents. Returns rows of (name, baseline, current, change, status), status is
+	'regression' or 'improvement' when the change exceeds threshold, otherwise 'same'. """
+	rows = []
+	for name, measure in current['benchmarks'].items():
+		before = baseline['benchmarks'].get(name)
+		if measure.get('skipped') or before is None or before.get('skipped'):
+			continue
+		change = (measure['median'] - before['median']) / before['median'] if before['median'] > 0 else 0.0
+		status = 'regression' if change > threshold else 'improvement' if change < -threshold else 'same'
+		rows.append((name, before['median'], measure['median'], change, status))
+	if baseline.get('config') != current.get('config'):
+		rows.append(('config', None, None, None, 'differs'))
+	return rows
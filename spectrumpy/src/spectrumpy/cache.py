@@ -0,0 +1,176 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+__all__ = ['WadlCache']
+
+class WadlCache:
+	"""Two tier (memory and disk) cache of parsed WADL resource models, keyed by WADL URL. """
+
+	default = None
+
+	# Version of the cached resource model, entries written with another version are ignored
+	modelVersion = 2
+
+	def __init__(self, directory=None, ttl=3600):
+		''' Constructor for this class. A directory of None keeps the cache in memory only. '''
+		self.directory = directory
+		self.ttl = ttl
+		self.entries = {}
+		self.lock = threading.Lock()
+		self.stats = {'hits':0, 'diskHits':0, 'misses':0, 'revalidated':0, 'invalidations':0}
+		self.timings = {'coldStart':[], 'warmStart':[]}
+		self.soapCache = None
+		if self.directory is not None:
+			os.makedirs(self.directory, exist_ok=True)
+
+	def Default():
+		"""Returns the process wide cache. The disk tier is enabled by the SPECTRUMPY_CACHE_DIR environment variable. """
+		if WadlCache.default is None:
+			WadlCache.default = WadlCache(os.environ.get('SPECTRUMPY_CACHE_DIR'))
+		return WadlCache.default
+
+	def SoapCache(self):
+		"""Returns the zeep cache of downloaded WSDL and XSD documents, a SQLite file in the cache directory that survives
+		restarts, or zeep's process wide memory cache without a directory. """
+		with self.lock:
+			if self.soapCache is None:
+				import zeep.cache
+				if self.directory is None:
+					self.soapCache = zeep.cache.InMemoryCache(timeout=self.ttl)
+				else:
+					self.soapCache = zeep.cache.SqliteCache(path=os.path.join(self.directory, 'wsdl.sqlite'), timeout=self.ttl)
+			return self.soapCache
+
+	def __path(self, url):
+		return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+	def __readDisk(self, url):
+		if self.directory is None:
+			return None
+		try:
+			with open(self.__path(url), 'r', encoding='utf-8') as file:
+				entry = json.load(file)
+		except (OSError, ValueError):
+			return None
+		if entry.get('url') != url or entry.get('version') != WadlCache.modelVersion:
+			return None
+		return entry
+
+	def __writeDisk(self, entry):
+		if self.directory is None:
+			return
+
+		#
+		# Write to a temporary file first so concurrent processes never read a partial entry.
+		#
+
+		fd, tmpPath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'w', encoding='utf-8') as file:
+				json.dump(entry, file)
+			os.replace(tmpPath, self.__path(entry['url']))
+		except OSError:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+
+	def Lookup(self, url):
+		"""Returns the cached entry for the WADL URL, fresh or stale, or None. """
+		with self.lock:
+			entry = self.entries.get(url)
+		if entry is None:
+			entry = self.__readDisk(url)
+			if entry is not None:
+				with self.lock:
+					self.stats['diskHits'] += 1
+					self.entries[url] = entry
+		return entry
+
+	def IsFresh(self, entry):
+		"""Indicates True/False if the entry is within its time to live. """
+		return entry is not None and (time.time() - entry['fetched']) < self.ttl
+
+	def Get(self, url):
+		"""Returns the cached entry for the WADL URL if it is still fresh, otherwise None. """
+		entry = self.Lookup(url)
+		with self.lock:
+			if self.IsFresh(entry):
+				self.stats['hits'] += 1
+				return entry
+			self.stats['misses'] += 1
+		return None
+
+	def Put(self, url, resources, objects, etag=None, lastModified=None):
+		"""Stores the parsed resource model for the WADL URL in both tiers. """
+		entry = {'version':WadlCache.modelVersion, 'url':url, 'resources':resources, 'objects':objects, 'etag':etag, 'lastModified':lastModified, 'fetched':time.time()}
+		with self.lock:
+			self.entries[url] = entry
+		self.__writeDisk(entry)
+		return entry
+
+	def Revalidated(self, url):
+		"""Restarts the time to live of an entry after the server confirmed it is unchanged. """
+		entry = self.Lookup(url)
+		if entry is None:
+			return None
+		entry = dict(entry)
+		entry['fetched'] = time.time()
+		with self.lock:
+			self.entries[url] = entry
+			self.stats['revalidated'] += 1
+		self.__writeDisk(entry)
+		return entry
+
+	def Invalidate(self, url=None):
+		"""Removes the entry for the WADL URL, or every entry when no URL is given, from both tiers. """
+		with self.lock:
+			urls = list(self.entries) if url is None else [url]
+			for key in urls:
+				self.entries.pop(key, None)
+			self.stats['invalidations'] += 1
+		if self.directory is None:
+			return
+		if url is None:
+			names = [name for name in os.listdir(self.directory) if name.endswith('.json')]
+			paths = [os.path.join(self.directory, name) for name in names]
+		else:
+			paths = [self.__path(url)]
+		for path in paths:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+	def RecordTiming(self, kind, seconds):
+		"""Records an APIManager start time, kind is 'coldStart' or 'warmStart'. """
+		with self.lock:
+			self.timings[kind].append(seconds)
+
+	def Timings(self):
+		"""Returns count, mean and last seconds for cold (parsed) and warm (cached) APIManager starts. """
+		summary = {}
+		with self.lock:
+			for kind in self.timings:
+				values = self.timings[kind]
+				summary[kind] = {
+					'count':len(values),
+					'mean':(sum(values) / len(values)) if len(values) > 0 else None,
+					'last':values[-1] if len(values) > 0 else None
+				}
+		return summary
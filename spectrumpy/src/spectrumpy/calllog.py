@@ -0,0 +1,217 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import os
+import re
+import json
+import queue
+import atexit
+import random
+import threading
+import time
+from datetime import datetime
+
+__all__ = ['CallLog']
+
+class CallLog:
+	"""Call log written by a background thread through a bounded queue, with body truncation, credential redaction,
+	sampling and size based rotation. Recording never blocks the caller, entries are dropped when the queue is full. """
+
+	logs = {}
+	logsLock = threading.Lock()
+
+	def __init__(self, path = 'CallLog.txt', maxQueue = 10000, maxBodyBytes = 1024, sampleRate = 1.0, maxBytes = 10*1024*1024, backupCount = 3, redact = True, format = 'text'):
+		''' Constructor for this class. format is 'text' (the classic CallLog.txt layout) or 'json' (one JSON object per line). '''
+		self.path = path
+		self.maxBodyBytes = maxBodyBytes
+		self.sampleRate = sampleRate
+		self.maxBytes = maxBytes
+		self.backupCount = backupCount
+		self.redact = redact
+		self.format = format
+		self.queue = queue.Queue(maxsize=maxQueue)
+		self.stats = {'recorded':0, 'sampledOut':0, 'dropped':0, 'written':0, 'rotations':0}
+		self.thread = threading.Thread(target=self.__Run, name='spectrumpy-calllog', daemon=True)
+		self.thread.start()
+		atexit.register(self.Flush)
+
+	def ForPath(path):
+		"""Returns the shared call log for the file path, creating it with default options on first use. """
+		with CallLog.logsLock:
+			log = CallLog.logs.get(path)
+			if log is None:
+				log = CallLog(path)
+				CallLog.logs[path] = log
+			return log
+
+	def Configure(path, **options):
+		"""Replaces the shared call log for the file path with one using the given options. """
+		with CallLog.logsLock:
+			previous = CallLog.logs.pop(path, None)
+			# The previous writer finishes its queue before the new one appends to the same file
+			if previous is not None:
+				previous.Close()
+			log = CallLog(path, **options)
+			CallLog.logs[path] = log
+		return log
+
+	def Record(self, url, username, password, requestType, sent = None, received = None, runtime = None, error = None):
+		"""Queues one call for writing. Successful calls are sampled, errors are always recorded. """
+		if error is None and self.sampleRate < 1.0 and random.random() >= self.sampleRate:
+			self.stats['sampledOut'] += 1
+			return
+		# Credentials may be given as numbers, the writer only handles text
+		password = None if password is None else str(password)
+		entry = {'url':url, 'user':username, 'password':password, 'type':requestType, 'sent':sent, 'received':received,
+			'runtime':runtime, 'error':error, 'time':datetime.now()}
+		try:
+			self.queue.put_nowait(entry)
+			self.stats['recorded'] += 1
+		except queue.Full:
+			self.stats['dropped'] += 1
+
+	def __Redact(self, text, password):
+		if not self.redact:
+			return text
+		if password:
+			text = text.replace(password, '********')
+		return re.sub(r'(?i)((?:password|pwd|passwd)=)[^&\s"<]*', r'\1********', text)
+
+	def __Body(self, body, password):
+		if body is None:
+			return None
+		if isinstance(body, bytes):
+			text = self.__Redact(body[:self.maxBodyBytes].decode('utf-8', 'replace'), password)
+		else:
+			text = self.__Redact(str(body)[:self.maxBodyBytes], password)
+		size = len(body) if isinstance(body, bytes) else len(str(body).encode('utf-8'))
+		if size > self.maxBodyBytes:
+			text += '... [{0} bytes]'.format(size)
+		return text
+
+	def __Size(self, body):
+		if body is None:
+			return 0
+		if isinstance(body, bytes):
+			return len(body)
+		return len(str(body).encode('utf-8'))
+
+	def __Format(self, entry):
+		password = entry['password']
+		record = {
+			'url':self.__Redact(str(entry['url']), password),
+			'user':entry['user'],
+			'password':'********' if self.redact else password,
+			'type':entry['type'],
+			'bytesSent':self.__Size(entry['sent']),
+			'bytesReceived':self.__Size(entry['received']),
+			'dataSent':self.__Body(entry['sent'], password),
+			'response':self.__Body(entry['received'], password),
+			'runtime':None if entry['runtime'] is None else str(entry['runtime']),
+			'error':entry['error'],
+			'time':str(entry['time'])
+		}
+		if self.format == 'json':
+			return json.dumps(record) + '\n'
+		if record['error'] is not None:
+			return 'URL: {url}\nUSER: {user}\nPW: {password}\nTYPE: {type}\nDATASENT: {dataSent}\nERROR: {error}\nTIME: {time}\n\n'.format(**record)
+		return ('URL: {url}\nUSER: {user}\nPW: {password}\nTYPE: {type}\nBYTES SENT: {bytesSent}\nBYTES RECEIVED: {bytesReceived}\n'
+			'DATASENT: {dataSent}\nRESPONSE: {response}\nRUNTIME: {runtime}\nTIME: {time}\n\n').format(**record)
+
+	def __Rotate(self):
+		for i in range(self.backupCount - 1, 0, -1):
+			source = '{0}.{1}'.format(self.path, i)
+			if os.path.exists(source):
+				os.replace(source, '{0}.{1}'.format(self.path, i + 1))
+		if self.backupCount > 0:
+			os.replace(self.path, self.path + '.1')
+		else:
+			os.remove(self.path)
+		self.stats['rotations'] += 1
+
+	def __Write(self, texts):
+
+		#
+		# Sizes are counted in encoded bytes, the file is rotated before the entry that would take it over maxBytes.
+		#
+
+		size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+		pending = []
+		for text in texts:
+			length = len(text.encode('utf-8'))
+			if self.maxBytes and size > 0 and size + length > self.maxBytes:
+				self.__Append(pending)
+				pending = []
+				self.__Rotate()
+				size = 0
+			pending.append(text)
+			size += length
+		self.__Append(pending)
+
+	def __Append(self, texts):
+		if len(texts) > 0:
+			with open(self.path, 'a', encoding='utf-8') as file:
+				file.write(''.join(texts))
+
+	def __Run(self):
+		while True:
+
+			#
+			# Write everything queued so far with a single open of the file.
+			#
+
+			items = [self.queue.get()]
+			while True:
+				try:
+					items.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+			# None is queued by Close to stop the thread
+			entries = [entry for entry in items if entry is not None]
+			try:
+				if len(entries) > 0:
+					self.__Write([self.__Format(entry) for entry in entries])
+					self.stats['written'] += len(entries)
+			except Exception:
+				# An entry that cannot be formatted or written must not stop the thread, Flush would wait for it forever
+				self.stats['dropped'] += len(entries)
+			finally:
+				for item in items:
+					self.queue.task_done()
+			if len(entries) < len(items):
+				return
+
+	def Flush(self, timeout = 10.0):
+		"""Blocks until every queued entry has been written, the writer thread has stopped or timeout seconds have passed.
+		Returns True when everything queued was written. """
+		deadline = time.monotonic() + timeout
+		with self.queue.all_tasks_done:
+			while self.queue.unfinished_tasks:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0 or not self.thread.is_alive():
+					return False
+				self.queue.all_tasks_done.wait(min(remaining, 0.1))
+		return True
+
+	def Close(self, timeout = 10.0):
+		"""Writes what is queued, stops the writer thread and removes the exit hook. Entries recorded afterwards are not written.
+		Returns True when the thread has stopped. """
+		atexit.unregister(self.Flush)
+		deadline = time.monotonic() + timeout
+		if self.thread.is_alive():
+			try:
+				self.queue.put(None, timeout=timeout)
+			except queue.Full:
+				return False
+			self.thread.join(max(0, deadline - time.monotonic()))
+		return not self.thread.is_alive()
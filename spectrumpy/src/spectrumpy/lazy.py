@@ -0,0 +1,42 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import importlib
+
+__all__ = ['LazyImport']
+
+class LazyImport:
+	"""Stands in for a module until one of its attributes is first read, then imports it. Bound in a module namespace under a
+	name, it replaces itself there with the module, so later lookups go straight to the module. """
+
+	def __init__(self, module, namespace = None, name = None):
+		''' Constructor for this class. module is the full module name, for example 'lxml.etree'. '''
+		self.__dict__['_module'] = module
+		self.__dict__['_namespace'] = namespace
+		self.__dict__['_name'] = module.rpartition('.')[2] if name is None else name
+
+	def __Load(self):
+		# The import system serializes concurrent imports of the module, rebinding the name is a single dict store
+		module = importlib.import_module(self._module)
+		if self._namespace is not None and self._namespace.get(self._name) is self:
+			self._namespace[self._name] = module
+		return module
+
+	def __getattr__(self, attribute):
+		return getattr(self.__Load(), attribute)
+
+	def __setattr__(self, attribute, value):
+		setattr(self.__Load(), attribute, value)
+
+	def __repr__(self):
+		return '<lazy module {0!r}>'.format(self._module)
@@ -0,0 +1,210 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import re
+import bisect
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+__all__ = ['CallMetrics', 'Histogram', 'ServiceName', 'PHASES']
+
+# Phases of a call, connect + ttfb + download make up the network time of a request
+PHASES = ('connect', 'ttfb', 'download', 'parse', 'convert', 'total')
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+def ServiceName(url):
+	"""Returns the metrics label of a Spectrum URL: the dataflow or SOAP service name, or FeatureService:<table> for feature queries. """
+	parts = urlsplit(url)
+	path = parts.path
+	if '/FeatureService/' in path:
+
+		#
+		# Label feature calls by table, for SQL queries by the first table of the FROM clause.
+		#
+
+		if path.endswith('/tables/features.json'):
+			q = parse_qs(parts.query).get('q')
+			match = re.search(r'(?i)\bfrom\s+"?(/[^"\s,)]+)', q[0]) if q else None
+			return 'FeatureService:' + (match.group(1) if match else 'query')
+		match = re.search(r'/tables(/.+)/[^/]+\.json$', path)
+		return 'FeatureService:' + match.group(1) if match else 'FeatureService'
+	segments = [segment for segment in path.split('/') if segment]
+	for marker in ('rest', 'soap'):
+		if marker in segments:
+			position = segments.index(marker)
+			if position + 1 < len(segments):
+				return segments[position + 1]
+	return segments[-1] if len(segments) > 0 else parts.netloc
+
+class Histogram:
+	"""Fixed bucket latency histogram. """
+
+	def __init__(self, buckets = LATENCY_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.count = 0
+		self.sum = 0.0
+		self.max = 0.0
+
+	def Observe(self, seconds):
+		"""Adds one observation, callers hold the registry lock. """
+		self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+		self.count += 1
+		self.sum += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	def Quantile(self, q):
+		"""Returns the upper bound of the bucket holding the q quantile, or max for the overflow bucket. """
+		if self.count == 0:
+			return None
+		rank = q * self.count
+		cumulative = 0
+		for i, count in enumerate(self.counts):
+			cumulative += count
+			if cumulative >= rank:
+				return self.buckets[i] if i < len(self.buckets) else self.max
+		return self.max
+
+	def Snapshot(self):
+		"""Returns count, sum, mean, max, p50/p95/p99 and the cumulative bucket counts. """
+		cumulative = 0
+		buckets = []
+		for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+			cumulative += count
+			buckets.append((bound, cumulative))
+		return {'count':self.count, 'sum':self.sum, 'mean':self.sum / self.count if self.count > 0 else None, 'max':self.max,
+			'p50':self.Quantile(0.5), 'p95':self.Quantile(0.95), 'p99':self.Quantile(0.99), 'buckets':buckets}
+
+class CallMetrics:
+	"""Per-service latency histograms by phase and throughput counters of all Spectrum calls. Subscribed callbacks receive every call record. """
+
+	default = None
+
+	def __init__(self, buckets = LATENCY_BUCKETS):
+		''' Constructor for this class. '''
+		self.bucketBounds = buckets
+		self.lock = threading.Lock()
+		self.services = {}
+		self.subscribers = []
+
+	def Default():
+		"""Returns the process wide registry used by transports created without one. """
+		if CallMetrics.default is None:
+			CallMetrics.default = CallMetrics()
+		return CallMetrics.default
+
+	def __Service(self, service):
+		entry = self.services.get(service)
+		if entry is None:
+			entry = {'calls':0, 'errors':0, 'bytesSent':0, 'bytesReceived':0, 'phases':{}}
+			self.services[service] = entry
+		return entry
+
+	def __Observe(self, entry, phase, seconds):
+		histogram = entry['phases'].get(phase)
+		if histogram is None:
+			histogram = Histogram(self.bucketBounds)
+			entry['phases'][phase] = histogram
+		histogram.Observe(seconds)
+
+	def Record(self, service, phases, bytesSent = 0, bytesReceived = 0, error = None, url = None):
+		"""Records one call with its phase timings in seconds, e.g. {'connect':0.01, 'ttfb':0.2, 'download':0.05, 'total':0.26}. """
+		with self.lock:
+			entry = self.__Service(service)
+			entry['calls'] += 1
+			entry['bytesSent'] += bytesSent
+			entry['bytesReceived'] += bytesReceived
+			if error is not None:
+				entry['errors'] += 1
+			for phase, seconds in phases.items():
+				if seconds is not None:
+					self.__Observe(entry, phase, seconds)
+			subscribers = list(self.subscribers)
+		self.__Publish(subscribers, {'service':service, 'url':url, 'phases':phases, 'bytesSent':bytesSent, 'bytesReceived':bytesReceived, 'error':error})
+
+	def Observe(self, service, phase, seconds):
+		"""Records a phase that completes after the call, such as parse or convert. """
+		with self.lock:
+			self.__Observe(self.__Service(service), phase, seconds)
+			subscribers = list(self.subscribers)
+		self.__Publish(subscribers, {'service':service, 'url':None, 'phases':{phase:seconds}, 'bytesSent':0, 'bytesReceived':0, 'error':None})
+
+	def __Publish(self, subscribers, record):
+		for callback in subscribers:
+			try:
+				callback(record)
+			except Exception:
+				pass
+
+	def Subscribe(self, callback):
+		"""Calls callback(record) after every recorded call or phase, returns the callback for Unsubscribe. """
+		with self.lock:
+			self.subscribers.append(callback)
+		return callback
+
+	def Unsubscribe(self, callback):
+		"""Removes a subscribed callback. """
+		with self.lock:
+			if callback in self.subscribers:
+				self.subscribers.remove(callback)
+
+	def Reset(self):
+		"""Clears all recorded metrics. """
+		with self.lock:
+			self.services = {}
+
+	def Snapshot(self):
+		"""Returns {service: {'calls', 'errors', 'bytesSent', 'bytesReceived', 'phases': {phase: histogram snapshot}}}. """
+		with self.lock:
+			return {service:{'calls':entry['calls'], 'errors':entry['errors'], 'bytesSent':entry['bytesSent'], 'bytesReceived':entry['bytesReceived'],
+				'phases':{phase:histogram.Snapshot() for phase, histogram in entry['phases'].items()}}
+				for service, entry in self.services.items()}
+
+	def PrometheusText(self, prefix = 'spectrum'):
+		"""Returns the metrics in the Prometheus text exposition format. """
+		snapshot = self.Snapshot()
+		lines = []
+		for name, key, kind in (('calls_total', 'calls', 'counter'), ('errors_total', 'errors', 'counter'),
+			('sent_bytes_total', 'bytesSent', 'counter'), ('received_bytes_total', 'bytesReceived', 'counter')):
+			lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+			for service in sorted(snapshot):
+				lines.append('{0}_{1}{{service="{2}"}} {3}'.format(prefix, name, self.__Label(service), snapshot[service][key]))
+		lines.append('# TYPE {0}_call_seconds histogram'.format(prefix))
+		for service in sorted(snapshot):
+			for phase in sorted(snapshot[service]['phases']):
+				histogram = snapshot[service]['phases'][phase]
+				labels = 'service="{0}",phase="{1}"'.format(self.__Label(service), phase)
+				for bound, count in histogram['buckets']:
+					le = '+Inf' if bound == float('inf') else repr(bound)
+					lines.append('{0}_call_seconds_bucket{{{1},le="{2}"}} {3}'.format(prefix, labels, le, count))
+				lines.append('{0}_call_seconds_sum{{{1}}} {2}'.format(prefix, labels, repr(histogram['sum'])))
+				lines.append('{0}_call_seconds_count{{{1}}} {2}'.format(prefix, labels, histogram['count']))
+		return '\n'.join(lines) + '\n'
+
+	def __Label(self, value):
+		return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+#
+# Time spent establishing connections on the calling thread, recorded by the transport's connection classes.
+#
+
+connectTimer = threading.local()
+
+def ResetConnectTime():
+	connectTimer.seconds = 0.0
+
+def ConnectTime():
+	return getattr(connectTimer, 'seconds', 0.0)
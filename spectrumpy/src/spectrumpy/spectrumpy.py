@@ -16,19 +16,28 @@ import os
 from pathlib import Path
 import sys
 import re
-import requests
 import time
+import threading
 from datetime import timedelta
 from datetime import datetime
-import zeep
-import lxml
-import urllib
 from urllib.parse import quote
 from urllib.error import HTTPError
-import base64
-from xml.dom.minidom import parse, parseString, Document
 import configparser
 import json
+from .cache import WadlCache
+from .calllog import CallLog
+from .batch import BatchRun, BatchResult, IterRows
+from .lazy import LazyImport
+
+#
+# Heavy dependencies are imported on first use, the transport and WADL modules with them.
+#
+
+requests = LazyImport('requests', globals())
+zeep = LazyImport('zeep', globals())
+etree = LazyImport('lxml.etree', globals())
+# saxutils imports urllib.request and http.client
+saxutils = LazyImport('xml.sax.saxutils', globals())
 
 def Info(msg):
 	time = datetime.now().strftime('%H:%M:%S')
@@ -43,9 +52,22 @@ def Error(msg):
 	print ('{0} ERROR: {1}'.format(time, msg))
 
 
-def GetHttpContent(url):
-	request = urllib.request.Request(url)
-	return urllib.request.urlopen(request).read()
+def GetHttpContent(url, transport=None):
+	from .transport import Transport
+	transport = Transport.Default() if transport is None else transport
+	response = transport.get(url)
+	response.raise_for_status()
+	return response.content
+
+def GetHttpResponse(url, headers=None, transport=None):
+	"""Returns (status, content, headers) for the URL. A 304 Not Modified response returns None content. """
+	from .transport import Transport
+	transport = Transport.Default() if transport is None else transport
+	response = transport.get(url, headers=headers)
+	if response.status_code == 304:
+		return (304, None, response.headers)
+	response.raise_for_status()
+	return (response.status_code, response.content, response.headers)
 
 class HttpConnection:
 	def __init__(self):
@@ -59,6 +81,11 @@ class HttpConnection:
 		self.ContentType = ''
 		self.Log = True
 		self.ReturnError = False
+		self.RaiseError = False
+		# Pooled transport of the server, None uses the process wide default
+		self.Transport = None
+		# Call log to record to, None uses the shared log of CallLogPath
+		self.CallLog = None
 
 	def Send(self):
 
@@ -66,13 +93,11 @@ class HttpConnection:
 		# Configure connection header.
 		#
 		
-		opener = urllib.request.build_opener(urllib.request.HTTPHandler)
-		request = urllib.request.Request(self.Url, data = self.Data)
-		base64string = base64.encodestring('{0}:{1}'.format(self.Username, self.Password).encode()).decode().replace('\n', '')
-		request.add_header('Authorization', 'Basic %s' % base64string)
-		request.add_header('Content-Type', self.ContentType)
-		request.add_header('Accept', self.ContentType)
-		request.get_method = lambda: self.RequestType.upper()
+		from .transport import Transport, BasicAuthHeader
+		transport = Transport.Default() if self.Transport is None else self.Transport
+		headers = {'Content-Type': self.ContentType, 'Accept': self.ContentType}
+		if self.Username:
+			headers['Authorization'] = BasicAuthHeader(self.Username, self.Password)
 		
 		#
 		# Attempt to send.
@@ -86,36 +111,38 @@ class HttpConnection:
 			#
 
 			startTime = datetime.now()
-			result = opener.open(request)
+			response = transport.request(self.RequestType.upper(), self.Url, data=self.Data, headers=headers)
+			response.raise_for_status()
 			runtime = (datetime.now() - startTime)
-			result = result.read()
+			result = response.content
 			
 
 			#
-			# Write execute time and other information to log file.
+			# Queue execute time and other information for the background log writer.
 			#
 
 			if self.Log:
-				with open(self.CallLogPath, 'a') as file:
-					file.write('URL: {0}\nUSER: {8}\nPW: {9}\nTYPE: {6}\nBYTES SENT: {1}\nBYTES RECEIVED: {2}\nDATASENT: {4}\nRESPONSE: {5}\nRUNTIME: {3}\nTIME: {7}\n\n'
-					.format(self.Url, len(str(self.Data)) * 4, len(result) * 4, runtime, str(self.Data), result, self.RequestType, datetime.now(), self.Username, self.Password))
+				self.__CallLog().Record(self.Url, self.Username, self.Password, self.RequestType, sent=self.Data, received=result, runtime=runtime)
 
 		#
 		# Capture error.
 		#
 
-		except urllib.error.URLError as e:
+		except requests.exceptions.RequestException as e:
+			if self.RaiseError:
+				raise
 			if self.ReturnError:
 				return str(e) + ' - ERROR!'
-			with open(self.CallLogPath, 'a') as file:
-				file.write('URL: {0}\nUSER: {4}\nPW: {5}\nTYPE: {2}\nDATASENT: {1}\nTIME: {3}\n\n'
-				.format(self.Url, str(self.Data), self.RequestType, datetime.now(), self.Username, self.Password))
+			self.__CallLog().Record(self.Url, self.Username, self.Password, self.RequestType, sent=self.Data, error=str(e))
 			Error('REST API ERROR: {0}\n{1}'.format(e, self.Url))
 		return result
 
+	def __CallLog(self):
+		return CallLog.ForPath(self.CallLogPath) if self.CallLog is None else self.CallLog
+
 class APIManager:
 
-	def __init__(self, apiUrl, doDebug):
+	def __init__(self, apiUrl, doDebug, cache=None, transport=None):
 		self.debug = doDebug
 
 		#
@@ -125,23 +152,77 @@ class APIManager:
 		self.Url = apiUrl
 		self.Resources = {}
 		self.Objects = {}
+		# A cache of None uses the process wide WadlCache, False disables caching.
+		self.Cache = WadlCache.Default() if cache is None else cache
+		self.FromCache = False
+		self.Transport = transport
+		startTime = time.perf_counter()
+
+		#
+		# Use the cached resource model while it is fresh.
+		#
+
+		entry = None
+		if self.Cache:
+			fresh = self.Cache.Get(self.Url)
+			if fresh is not None:
+				self.__LoadEntry(fresh)
+				self.Cache.RecordTiming('warmStart', time.perf_counter() - startTime)
+				return
+			entry = self.Cache.Lookup(self.Url)
+
+		#
+		# Revalidate a stale entry with a conditional request, otherwise fetch the WADL.
+		#
+
+		headers = {}
+		if entry is not None:
+			if entry.get('etag'):
+				headers['If-None-Match'] = entry['etag']
+			if entry.get('lastModified'):
+				headers['If-Modified-Since'] = entry['lastModified']
+		status, wadl, responseHeaders = GetHttpResponse(self.Url, headers, self.Transport)
+		if status == 304 and entry is not None:
+			if (self.debug == True):
+				print ('WADL not modified, using cached resources for {0}'.format(self.Url))
+			self.__LoadEntry(self.Cache.Revalidated(self.Url))
+			self.Cache.RecordTiming('warmStart', time.perf_counter() - startTime)
+			return
 
 		#
-		# Process WADL XML content.
+		# Process WADL XML content, the parser fetches and parses the included grammars as it streams through the WADL.
 		#
-		wadl = GetHttpContent(self.Url)
-		wadlDom = parseString(wadl)
 
 		if (self.debug == True):
 			print ('WADL:')
 			print (wadl)
-			# print (wadlDom.toprettyxml(indent="  "))
 			print ('')
 			print ('Parsing WADL for defined methods...')
 
-		self.__ProcessAPIXml(wadlDom, None, None, None)
+		from .wadl import WadlParser
+		parser = WadlParser(self.Url, lambda url: GetHttpContent(url, self.Transport), self.debug)
+		self.Resources, self.Objects = parser.Parse(wadl)
+		self.base = parser.base
 		self.__CombineObjectAttributes()
 
+		if self.Cache:
+			self.Cache.Put(self.Url, self.Resources, self.Objects, responseHeaders.get('ETag'), responseHeaders.get('Last-Modified'))
+			self.Cache.RecordTiming('coldStart', time.perf_counter() - startTime)
+
+	#
+	# Define function for loading the resource model from a cache entry.
+	#
+
+	def __LoadEntry(self, entry):
+		self.Resources = entry['resources']
+		self.Objects = entry['objects']
+		self.FromCache = True
+
+	def Invalidate(self):
+		"""Removes this WADL from the cache, the next APIManager for the URL fetches and parses it again. """
+		if self.Cache:
+			self.Cache.Invalidate(self.Url)
+
 	#
 	# Define recursive helper function for combining parent/child attributes. 
 	#
@@ -161,136 +242,6 @@ class APIManager:
 			for base1 in self.Objects[objectA]['bases']:
 				self.Objects[objectA]['attributes'] += list(self.__CombineObjectAttributesHelp(base1))
 
-	#
-	# Define function for processing WADL grammar pages. 
-	#
-
-	def __ProcessGrammerXml(self, node, complexType):
-		if (node == None):
-			return
-
-		#
-		# Capture initial complexType node.
-		#
-
-		if (node.nodeName == 'xs:complexType'):
-			complexType = node.getAttributeNode('name').nodeValue
-			self.Objects[complexType] = {}
-			self.Objects[complexType]['attributes'] = []
-			self.Objects[complexType]['bases'] = []
-			self.Objects[complexType]['elements'] = []
-		elif not complexType is None:
-
-			#
-			# Capture attribute node.
-			#
-
-			if (node.nodeName == 'xs:attribute'):
-				self.Objects[complexType]['attributes'].append(node.getAttributeNode('name').nodeValue)
-
-			#
-			# Capture extension object (inherited object).
-			#
-
-			elif (node.nodeName == 'xs:extension'):
-				baseName = node.getAttributeNode('base').nodeValue
-				baseName = re.sub('tns\:', '', baseName)
-				self.Objects[complexType]['bases'].append(baseName)
-
-			#
-			# Capture element object.
-			#
-
-			elif (node.nodeName == 'xs:element'):
-				nameNode = node.getAttributeNode('name')
-				if not (nameNode == None):
-					self.Objects[complexType]['elements'].append(nameNode.nodeValue)
-
-		#
-		# Continue to process child nodes recursively.
-		#
-
-		for childNode in node.childNodes:
-			self.__ProcessGrammerXml(childNode, complexType)
-
-	def __ProcessAPIXml(self, node, parent, currentUrl, currentApiName):
-		if (node == None):
-			return
-
-		#
-		# Capture include node, which will contain object definitions.
-		#
-
-		if (node.nodeName == 'include'): 
-			grammerhref = re.sub('[^/]+\Z', '', self.Url) + node.getAttributeNode('href').nodeValue
-			self.__ProcessGrammerXml(parseString(GetHttpContent(grammerhref)), None)
-
-		#
-		# Capture resources node, which will contain the base URL.
-		#
-
-		elif (node.nodeName == 'resources'):
-			self.base = currentUrl = re.sub('/\Z', '', node.getAttributeNode('base').nodeValue)
-
-		#
-		# Capture resource node, which will contain a base API object.
-		#
-
-		elif (node.nodeName == 'resource'):
-			currentUrl += node.getAttributeNode('path').nodeValue
-
-		#
-		# Capture method node, which will be a API call for the current parent.
-		#
-
-		elif (node.nodeName == 'method'):
-			requestType = node.getAttributeNode('name').nodeValue
-			method = re.sub('(\A/)|(/\Z)', '', currentUrl.replace(self.base, ''))
-			method = '{0}_{1}'.format(re.sub('/', '_', method), requestType)
-			currentApiName = method.replace('.','_')
-			if (self.debug == True):
-				print ('   Processing method: {0}, apiName: {1}, method: {2}, requestType: {3}'.format(node.getAttributeNode('name').nodeValue, currentApiName, method, requestType))
-			self.Resources[currentApiName] = {}
-			self.Resources[currentApiName]['requesttype'] = requestType
-			self.Resources[currentApiName]['contentType'] = 'application/xml'
-			self.Resources[currentApiName]['method'] = method
-			self.Resources[currentApiName]['url'] = currentUrl
-			self.Resources[currentApiName]['params'] = {}
-
-		#
-		# Capture XML response and request node, will be the request (object) type and response type of current APL call.
-		#
-
-		elif ((node.nodeName == 'ns2:representation') or (node.nodeName == 'representation')):
-			if not (node.getAttributeNode('mediaType') is None):
-				self.Resources[currentApiName]['contentType'] = node.getAttributeNode('mediaType').nodeValue
-			if not (node.getAttributeNode('element') is None):
-				if (node.getAttributeNode('mediaType').nodeValue == 'application/xml'):
-					if (parent.nodeName == 'request'):
-						self.Resources[currentApiName]['xmlrequest'] = node.getAttributeNode('element').nodeValue
-					else:
-						self.Resources[currentApiName]['xmlresponse'] = node.getAttributeNode('element').nodeValue
-				
-		#
-		# Capture URL parameter node, will be a parameter for the URL.
-		#
-
-		elif (node.nodeName == 'param'):
-			if not (currentApiName is None):
-				name = node.getAttributeNode('name').nodeValue
-				typeA = node.getAttributeNode('type').nodeValue
-				arg = name.replace(".", "_");
-				if (self.debug == True):
-					print ('      Parameter {0}, name: {1}, type: {2}'.format(arg, name, typeA))
-				self.Resources[currentApiName]['params'][arg] = {'name':name, 'type':typeA}
-
-		#
-		# Continue to process child nodes recursively.
-		#
-		
-		for childNode in node.childNodes:
-			self.__ProcessAPIXml(childNode, node, currentUrl, currentApiName)
-
 	def DisplayHelp(self):
 		innerSelf = self
 		for resource in innerSelf.Resources:
@@ -309,17 +260,6 @@ class APIManager:
 	def GetConnection(self, username, password, returnError = False):
 		innerSelf = self
 
-		#
-		# Define decorator fuction which is used to force the "resource" parameter into API calls.
-		#
-
-		def createFuction(resource):
-			def wrap(function):
-				def wrapped(* args, ** kwargs):
-					return function(args, kwargs, resource)
-				return wrapped
-			return wrap
-
 		#
 		# Define connection class using META programming.
 		#
@@ -328,94 +268,315 @@ class APIManager:
 			def __init__ (self, doDebug):
 				self.debug = doDebug
 				self.Apis = {}
+				self.Bindings = {}
 				self.username = username
 				self.password = password
 				self.ReturnError = returnError
 				for resource in innerSelf.Resources:
-					#method = innerSelf.Resources[resource]['method']
-					
+
 					#
-					# Define API fuction.
+					# Compile the resource once, the API function only encodes arguments and sends.
 					#
 
-					@createFuction(resource)
-					def api(args, kwargs, resource):
-
-						#
-						# Create connection object.
-						#
-
-						connection = HttpConnection()
-						connection.Username = self.username
-						connection.Password = self.password
-						connection.ContentType = innerSelf.Resources[resource]['contentType']
-						connection.RequestType = innerSelf.Resources[resource]['requesttype']
-						connection.ReturnError = self.ReturnError
-						connection.Url = innerSelf.Resources[resource]['url']
-
-						#
-						# Check and set connection.
-						#
-
-						firstUrlArg = True
-						requestXmlObject = None if not 'xmlrequest' in innerSelf.Resources[resource] else innerSelf.Resources[resource]['xmlrequest']
-						xmlElements = ''
-						xmlAttributes = ''
-						for argument in kwargs:
-						
-							#
-							# Check if argument is URL parameter.
-							#
-
-							if argument in innerSelf.Resources[resource]['params']:
-								firstChar = '?' if firstUrlArg else '&'
-								connection.Url += '{0}{1}={2}'.format(firstChar, innerSelf.Resources[resource]['params'][argument]['name'], quote(kwargs[argument],safe=''))
-								firstUrlArg = False
-								continue
-
-							#
-							# Check if argument is XML parameter.
-							#
-	
-							if not (requestXmlObject is None):
-								if argument in innerSelf.Objects[requestXmlObject]['attributes']:
-									xmlAttributes += ' {0}="{1}"'.format(argument, kwargs[argument])
-									continue
-								if argument in innerSelf.Objects[requestXmlObject]['elements']:
-									xmlElements += '<{0}>{1}</{0}>'.format(argument, kwargs[argument])
-									continue
+					binding = ServiceBinding(innerSelf, resource, self.username, self.password, self.ReturnError, self.debug, innerSelf.Transport)
 
-							#
-							# At this point throw error because given parameter was not found.
-							#
+					#
+					# Set function call and information.
+					#
 
-							Error('Invalid API argument API: {0}, Argument {1}={2}'.format(resource, argument,kwargs[argument]))
+					self.__dict__[resource]=binding.Call
+					self.Apis[resource] = binding.Call
+					self.Bindings[resource] = binding
+		return Connection(self.debug)
 
-						#
-						# Append XML meta data if any XML parameters were added.
-						#
+class ServiceBinding:
+	"""A compiled WADL resource: URL template, parameter map and request object lookups resolved once for reuse. """
 
-						if not requestXmlObject is None:
-							connection.Data = '<?xml version="1.0" ?><{0}{1}>{2}</{0}>'.format(requestXmlObject, xmlAttributes, xmlElements)
+	def __init__(self, apiManager, resource, username, password, returnError = False, debug = False, transport = None):
+		definition = apiManager.Resources[resource]
+		self.Manager = apiManager
+		self.Resource = resource
+		self.Url = definition['url']
+		self.RequestType = definition['requesttype']
+		self.ContentType = definition['contentType']
+		self.Username = username
+		self.Password = password
+		self.ReturnError = returnError
+		self.debug = debug
+		self.Transport = transport
 
-						#
-						# Send request.
-						#
-						if (self.debug == True):
-							print ('Request URL: {0}'.format(connection.Url))
-							if not requestXmlObject is None:
-								print ('Request payload: {0}'.format(connection.Data))
+		#
+		# Map python argument names to URL parameter names.
+		#
 
-						return connection.Send()
+		self.Params = {}
+		for arg in definition['params']:
+			self.Params[arg] = definition['params'][arg]['name']
 
-					#
-					# Set function call and information.
-					#
+		#
+		# Request object attributes and elements, inheritance is already combined by the APIManager.
+		#
 
-					self.__dict__[resource]=api
-					self.Apis[resource] = api
-		return Connection(self.debug)
+		self.RequestObject = definition.get('xmlrequest')
+		self.Attributes = frozenset()
+		self.Elements = frozenset()
+		if self.RequestObject in apiManager.Objects:
+			self.Attributes = frozenset(apiManager.Objects[self.RequestObject]['attributes'])
+			self.Elements = frozenset(apiManager.Objects[self.RequestObject]['elements'])
+
+	def Encode(self, kwargs, raiseError = False):
+		"""Returns the (url, data) pair of the request for the supplied arguments. """
+		url = self.Url
+		firstUrlArg = True
+		xmlElements = ''
+		xmlAttributes = ''
+		for argument in kwargs:
+
+			#
+			# Check if argument is URL parameter.
+			#
+
+			if argument in self.Params:
+				firstChar = '?' if firstUrlArg else '&'
+				url += '{0}{1}={2}'.format(firstChar, self.Params[argument], quote(str(kwargs[argument]),safe=''))
+				firstUrlArg = False
+				continue
+
+			#
+			# Check if argument is XML parameter.
+			#
+
+			if argument in self.Attributes:
+				xmlAttributes += ' {0}="{1}"'.format(argument, kwargs[argument])
+				continue
+			if argument in self.Elements:
+				xmlElements += '<{0}>{1}</{0}>'.format(argument, kwargs[argument])
+				continue
+
+			#
+			# At this point throw error because given parameter was not found.
+			#
+
+			message = 'Invalid API argument API: {0}, Argument {1}={2}'.format(self.Resource, argument,kwargs[argument])
+			if raiseError:
+				raise ValueError(message)
+			Error(message)
+
+		#
+		# Append XML meta data if any XML parameters were added.
+		#
+
+		data = None
+		if not self.RequestObject is None:
+			data = '<?xml version="1.0" ?><{0}{1}>{2}</{0}>'.format(self.RequestObject, xmlAttributes, xmlElements)
+		return (url, data)
+
+	def Call(self, *args, **kwargs):
+		"""Sends the request for the supplied arguments and returns the response content. """
+		return self.Send(kwargs)
+
+	def Send(self, kwargs, raiseError = False):
+		"""Sends the request for the arguments dict. With raiseError failures raise instead of being logged. """
+		url, data = self.Encode(kwargs, raiseError)
+		connection = HttpConnection()
+		connection.Username = self.Username
+		connection.Password = self.Password
+		connection.ContentType = self.ContentType
+		connection.RequestType = self.RequestType
+		connection.ReturnError = self.ReturnError
+		connection.RaiseError = raiseError
+		connection.Url = url
+		connection.Data = data
+		connection.Transport = self.Transport
 
+		#
+		# Send request.
+		#
+		if (self.debug == True):
+			print ('Request URL: {0}'.format(connection.Url))
+			if not data is None:
+				print ('Request payload: {0}'.format(connection.Data))
+
+		return connection.Send()
+
+
+class BatchBinding:
+	"""Packs many input rows into one XML request document and splits the response back into per row results. """
+
+	def __init__(self, apiManager, resource, username, password, debug = False, transport = None, maxPayloadBytes = 262144, maxRows = 1000):
+		definition = apiManager.Resources[resource]
+		self.Manager = apiManager
+		self.Resource = resource
+		self.Url = definition['url']
+		self.RequestType = definition['requesttype']
+		self.ContentType = definition['contentType']
+		self.Username = username
+		self.Password = password
+		self.debug = debug
+		self.Transport = transport
+		self.MaxPayloadBytes = maxPayloadBytes
+		self.MaxRows = maxRows
+
+		#
+		# Locate the repeated row element of the request and response objects, e.g. Input/Row and Output/Row.
+		#
+
+		self.RequestObject = re.sub(r'\A[^:]*:', '', definition.get('xmlrequest', ''))
+		self.ResponseObject = re.sub(r'\A[^:]*:', '', definition.get('xmlresponse', ''))
+		self.RowPath, rowType = self.__FindRows(self.RequestObject)
+		if self.RowPath is None:
+			raise ValueError('No repeated row element found in request object {0} of {1}'.format(self.RequestObject, resource))
+		self.ResponseRowPath, responseRowType = self.__FindRows(self.ResponseObject)
+		self.RowAttributes, self.RowElements = self.__Members(rowType)
+		self.RequestElements = apiManager.Objects[self.RequestObject]['elementTypes']
+
+		#
+		# The document around the rows is the same for every batch.
+		#
+
+		self.DocumentStart = '<?xml version="1.0" ?><{0}>'.format(self.RequestObject)
+		self.RowsStart = ''.join(['<{0}>'.format(name) for name in self.RowPath[:-1]])
+		self.DocumentEnd = ''.join(['</{0}>'.format(name) for name in reversed(self.RowPath[:-1])]) + '</{0}>'.format(self.RequestObject)
+
+	def __FindRows(self, objectName):
+		objects = self.Manager.Objects
+		queue = [(objectName, [])]
+		visited = set()
+		while len(queue) > 0:
+			name, path = queue.pop(0)
+			if not name in objects or name in visited:
+				continue
+			visited.add(name)
+			elementTypes = objects[name].get('elementTypes', {})
+			for element in objects[name]['elements']:
+				elementType = elementTypes.get(element)
+				if element in objects[name].get('repeated', []) and elementType in objects:
+					return (path + [element], elementType)
+				queue.append((elementType, path + [element]))
+		return (None, None)
+
+	def __Members(self, objectName):
+		attributes = set(self.Manager.Objects[objectName]['attributes'])
+		elements = list(self.Manager.Objects[objectName]['elements'])
+		for base in self.Manager.Objects[objectName]['bases']:
+			if base in self.Manager.Objects:
+				baseAttributes, baseElements = self.__Members(base)
+				attributes |= baseAttributes
+				elements = [element for element in baseElements if not element in elements] + elements
+		return (frozenset(attributes), elements)
+
+	def EncodeRow(self, row):
+		"""Returns the XML of one row, raising ValueError for arguments the row object does not define. """
+		attributes = ''
+		elements = ''
+		for argument in row:
+			value = row[argument]
+			if value is None:
+				continue
+			if argument in self.RowAttributes:
+				attributes += ' {0}={1}'.format(argument, saxutils.quoteattr(str(value)))
+			elif argument in self.RowElements:
+				elements += '<{0}>{1}</{0}>'.format(argument, saxutils.escape(str(value)))
+			else:
+				raise ValueError('Invalid API argument API: {0}, Argument {1}={2}'.format(self.Resource, argument, value))
+		return '<{0}{1}>{2}</{0}>'.format(self.RowPath[-1], attributes, elements)
+
+	def EncodeOptions(self, options):
+		"""Returns the XML of the request options element for a dict of option names and values. """
+		if not options:
+			return ''
+		name = None
+		for element in self.RequestElements:
+			if element.lower() == 'options':
+				name = element
+		if name is None:
+			raise ValueError('Request object {0} has no options element'.format(self.RequestObject))
+		elements = ''.join(['<{0}>{1}</{0}>'.format(option, saxutils.escape(str(options[option]))) for option in options])
+		return '<{0}>{1}</{0}>'.format(name, elements)
+
+	def Chunks(self, rows, maxPayloadBytes = None, maxRows = None):
+		"""Groups rows into batches whose request documents stay within the payload budget. Yields lists of (index, row, xml, error). """
+		maxPayloadBytes = self.MaxPayloadBytes if maxPayloadBytes is None else maxPayloadBytes
+		maxRows = self.MaxRows if maxRows is None else maxRows
+		overhead = len(self.DocumentStart) + len(self.RowsStart) + len(self.DocumentEnd)
+		chunk = []
+		size = overhead
+		for index, row in IterRows(rows):
+			try:
+				xml = self.EncodeRow(row)
+			except ValueError as e:
+				chunk.append((index, row, None, e))
+				continue
+			rowSize = len(xml.encode('utf-8'))
+			if len(chunk) > 0 and (size + rowSize > maxPayloadBytes or len(chunk) >= maxRows):
+				yield chunk
+				chunk = []
+				size = overhead
+			chunk.append((index, row, xml, None))
+			size += rowSize
+		if len(chunk) > 0:
+			yield chunk
+
+	def __ToDict(self, node):
+		result = dict(node.attrib)
+		for child in node:
+			result[etree.QName(child).localname] = child.text if len(child) == 0 else self.__ToDict(child)
+		return result
+
+	def Decode(self, content):
+		"""Returns the response rows as a list of dicts. """
+		nodes = [etree.fromstring(content)]
+		for name in self.ResponseRowPath or []:
+			nodes = [child for node in nodes for child in node if isinstance(child.tag, str) and etree.QName(child).localname == name]
+		return [self.__ToDict(node) for node in nodes]
+
+	def SendChunk(self, chunk, options = None):
+		"""Sends one batch in a single request and returns a BatchResult for every row of the chunk. """
+		encoded = [xml for index, row, xml, error in chunk if not xml is None]
+		outputs = []
+		if len(encoded) > 0:
+			connection = HttpConnection()
+			connection.Username = self.Username
+			connection.Password = self.Password
+			connection.ContentType = self.ContentType
+			connection.RequestType = self.RequestType
+			connection.RaiseError = True
+			connection.Transport = self.Transport
+			connection.Url = self.Url
+			connection.Data = self.DocumentStart + self.EncodeOptions(options) + self.RowsStart + ''.join(encoded) + self.DocumentEnd
+			if (self.debug == True):
+				print ('Request URL: {0}, rows: {1}, payload bytes: {2}'.format(connection.Url, len(encoded), len(connection.Data)))
+			outputs = self.Decode(connection.Send())
+
+		#
+		# Rows are returned in request order, the split is only possible when every row produced one output row.
+		#
+
+		mismatch = None
+		if len(outputs) != len(encoded):
+			mismatch = ValueError('Response contains {0} rows for {1} request rows'.format(len(outputs), len(encoded)))
+		results = []
+		position = 0
+		for index, row, xml, error in chunk:
+			if xml is None:
+				results.append(BatchResult(index, row, error=error))
+			elif not mismatch is None:
+				results.append(BatchResult(index, row, error=mismatch))
+			else:
+				results.append(BatchResult(index, row, output=outputs[position]))
+				position += 1
+		return results
+
+	def Call(self, rows, options = None, workers = 1, maxPayloadBytes = None, maxRows = None):
+		"""Sends the rows in payload bounded batches, workers at a time, and yields a BatchResult per row in input order. """
+		run = BatchRun(lambda chunk: self.SendChunk(chunk, options), self.Chunks(rows, maxPayloadBytes, maxRows), workers, ordered=True)
+		for result in run:
+			if result.error is None:
+				for rowResult in result.output:
+					yield rowResult
+			else:
+				for index, row, xml, error in result.input:
+					yield BatchResult(index, row, error=result.error if error is None else error)
 
 class Servers:
 	def _read_config_(config):
@@ -440,6 +601,94 @@ class Servers:
 			return server
 		return None
 				
+class SpectrumServices:
+	"""Proxy of a server's REST services, services.MyFlow(**kwargs) calls the dataflow. Looking up a service resolves and
+	compiles only that service, the /rest index is fetched when the list of services is needed. """
+
+	def __init__(self, server):
+		''' Constructor for this class. '''
+		self.server = server
+		self.debug = server.debug
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		return self.__Resolve(name)
+
+	def __dir__(self):
+		# Services and their help functions from the /rest index, for tab completion
+		try:
+			services = self.server.ServiceNames()
+		except Exception:
+			services = []
+		return sorted(set(object.__dir__(self)) | set(services) | set(['Help_' + service for service in services]))
+
+	def __Resolve(self, name):
+		function = self.__dict__.get(name)
+		if function is not None:
+			return function
+		server = self.server
+		if name.startswith('Help_'):
+			service = name[len('Help_'):]
+			def function():
+				binding = server.GetServiceBinding(service)
+				if binding is None:
+					raise KeyError('Unknown Spectrum service: {0}'.format(service))
+				binding.Manager.DisplayHelp()
+		else:
+			service = name
+			def function(* args, ** kwargs):
+				if (self.debug == True):
+					print ('Requested Service: {0}, supplied arguments:'.format(service))
+					for arg in args:
+						print("   arg:", arg)
+					for key, value in kwargs.items():
+						print("   {0} = {1}".format(key, value))
+					print ('')
+				# The binding is compiled from the wadl document on first use and reused afterwards
+				binding = server.GetServiceBinding(service)
+				if binding is None:
+					raise KeyError('Unknown Spectrum service: {0}'.format(service))
+				response = binding.Call(**kwargs)
+				if not response is None:
+					response = response.decode('utf-8')
+					if (self.debug == True):
+						print (response)
+				return response
+		# Later lookups find the function in the instance without calling __getattr__
+		self.__dict__[name] = function
+		return function
+
+	@property
+	def Apis(self):
+		"""Service name => function for every service in the server's /rest index. """
+		return {service:self.__Resolve(service) for service in self.server.ServiceNames()}
+
+	@property
+	def ApiHelps(self):
+		"""Service name => help function for every service in the server's /rest index. """
+		return {service:self.__Resolve('Help_'+service) for service in self.server.ServiceNames()}
+
+	def Help(self, service):
+		self.__Resolve('Help_'+service)()
+
+	def map(self, service, rows, workers = 8, ordered = True, progress = None):
+		"""Runs the service over a DataFrame or iterable of kwargs dicts on a bounded thread pool. Returns a BatchRun. """
+		server = self.server
+		if workers > server.transport.poolMaxSize:
+			Warning('map workers ({0}) exceed the transport pool size ({1}), extra connections will not be kept alive'.format(workers, server.transport.poolMaxSize))
+		def call(kwargs):
+			binding = server.GetServiceBinding(service)
+			if binding is None:
+				raise KeyError('Unknown Spectrum service: {0}'.format(service))
+			response = binding.Send(kwargs, raiseError = True)
+			return None if response is None else response.decode('utf-8')
+		return BatchRun(call, rows, workers, ordered, progress)
+
+	def batch(self, service, rows, options = None, workers = 1, maxPayloadBytes = 262144, maxRows = 1000):
+		"""Runs the service over rows packed many per request within a payload budget. Yields a BatchResult per row. """
+		return self.server.GetBatchBinding(service).Call(rows, options, workers, maxPayloadBytes, maxRows)
+
 class Server:
 	def __init__(self):
 		self.url='http://localhost:8080/'
@@ -448,148 +697,178 @@ class Server:
 		self.spectrumServices = None
 		self.debug = False
 		
-	def __init__(self, url, credentials, debug = False):
+	def __init__(self, url, credentials, debug = False, wadlCache = None, transport = None, servicesTtl = 3600):
 		''' Constructor for this class. '''
 		self.url=url
 		self.credentials=credentials
 		self.Services = {}
 		self.spectrumServices = None
+		self.asyncSpectrumServices = None
 		doDebug = debug
 		self.debug=doDebug
+		self.wadlCache=wadlCache
+		# One pooled keep-alive transport per server for REST, FeatureService and SOAP calls
+		from .transport import Transport
+		self.transport = Transport(credentials) if transport is None else transport
+		self.bindings = {}
+		# Guards the bindings and the per binding locks, a binding is compiled under its own lock so slow services do not block others
+		self.bindingLock = threading.Lock()
+		self.bindingLocks = {}
+		# Service name => WADL URL from the /rest index, fetched on demand and kept for servicesTtl seconds
+		self.servicesTtl = servicesTtl
+		self.servicesFetched = None
+		self.discoveryLock = threading.Lock()
+		# zeep clients by WSDL path, compiled once per server
+		self.soapServices = {}
+		self.soapLock = threading.Lock()
 		#self.__AddRestServices()
 		
 	def __GetRestServices(self):
-		opener = urllib.request.build_opener(urllib.request.HTTPHandler)
-		request = urllib.request.Request(self.url + 'rest')
-		base64string = base64.encodestring('{0}:{1}'.format(self.credentials[0], self.credentials[1]).encode()).decode().replace('\n', '')
-		request.add_header('Authorization', 'Basic %s' % base64string)
-		result = None
-		result = opener.open(request)
-		encoding = result.headers.get_content_charset('utf-8')
-		result = result.read().decode(encoding)
-		#if (self.debug == True):
-		#	print ('Spectrum Rest services: {0}'.format(result))
-
-		# HACK!!! The html returned from Spectrum is non-standard and the python DOM parser doesn't like it, these should fix it up
-		result = result.replace('<HEAD>','<head>')
-		result = result.replace('<HTML>','<html>')
-		result = result.replace('"><meta','"/><meta')
-		result = result.replace('"><title','"/><title')
+		response = self.transport.get(self.url + 'rest')
+		response.raise_for_status()
+		encoding = response.encoding if 'charset' in response.headers.get('Content-Type', '') else 'utf-8'
 		if (self.debug == True):
-			print ('Spectrum Rest services: {0}'.format(result))
+			print ('Spectrum Rest services: {0}'.format(response.content.decode(encoding, 'replace')))
+
+		return response.content, encoding
+
+	def __DiscoverServices(self, refresh = False):
+		# Concurrent first callers wait for one fetch of the index instead of each fetching it
+		with self.discoveryLock:
+			if not refresh and self.servicesFetched is not None and (time.time() - self.servicesFetched) < self.servicesTtl:
+				return
+			from .wadl import ParseServiceIndex
+			content, encoding = self.__GetRestServices()
+			self.Services = ParseServiceIndex(content, self.url, encoding, self.debug)
+			self.servicesFetched = time.time()
 
-		return result
-	
-	def __ProcessRestServices(self, node, parent, currentUrl):
-		if (node == None):
-			if (self.debug == True):
-				print('Node is empty, returning')
-			return
-			
-		if ((node.nodeType == node.TEXT_NODE) and (parent.nodeName == 'a') and (node.nodeValue.endswith('?_wadl'))):
-			service_name = node.nodeValue.replace(self.url + 'rest/','').replace('?_wadl','')
-			if (self.debug == True):
-				print ('Service {0} : {1}'.format(service_name, node.nodeValue))
-			self.Services[service_name] = node.nodeValue
-		
-		for childNode in node.childNodes:
-			self.__ProcessRestServices(childNode, node, currentUrl)
-	
 	def SpectrumServices(self):
+		"""Returns the proxy of the server's REST services. Nothing is fetched here, each service is resolved on first use. """
 		if self.spectrumServices == None:
-			innerSelf = self
-			dom = parseString(self.__GetRestServices())
-			if (self.debug == True):
-				print (dom.toprettyxml(indent="  "))
+			self.spectrumServices = SpectrumServices(self)
+		return self.spectrumServices
 
-			self.__ProcessRestServices(dom,None,None)
-			
-			#
-			# Define decorator fuction which is used to force the services into functions
-			#
-			def createFuction(service):
-				def wrap(function):
-					def wrapped(* args, ** kwargs):
-						if (self.debug == True):
-							print ('Requested Service: {0}, supplied arguments:'.format(service))
-							for arg in args:
-								print("   arg:", arg)
-							for key, value in kwargs.items():
-								print("   {0} = {1}".format(key, value))
-							print ('')
-						return function(args, kwargs, service)
-					return wrapped
-				return wrap
-
-			def createHelpFuction(service):
-				def wrap(function):
-					def wrapped():
-						return function(service)
-					return wrapped
-				return wrap
+	def ServiceNames(self, refresh = False):
+		"""Returns the names of the services in the /rest index, fetched on first use and again after servicesTtl seconds. """
+		self.__DiscoverServices(refresh)
+		return list(self.Services)
+
+	def ServiceUrl(self, service):
+		"""Returns the WADL URL of the service, from the /rest index when it is known, otherwise by Spectrum's URL convention. """
+		return self.Services.get(service, self.url + 'rest/' + service + '?_wadl')
+
+	def __BindingLock(self, key):
+		with self.bindingLock:
+			return self.bindingLocks.setdefault(key, threading.Lock())
+
+	def GetServiceBinding(self, service, resource = 'results_json_GET'):
+		"""Returns the compiled binding for the service resource, compiling it from the WADL on first use. """
+		key = (service, resource)
+		binding = self.bindings.get(key)
+		if binding is None:
+			with self.__BindingLock(key):
+				binding = self.bindings.get(key)
+				if binding is None:
+					#
+					# Resolve only this service, the /rest index is fetched when its WADL is not where Spectrum usually puts it.
+					#
+
+					url = self.ServiceUrl(service)
+					try:
+						# APIManager for this URL (rest service) is where the wadl document is actually fetched and parsed
+						apiManager = APIManager(url, self.debug, self.wadlCache, self.transport)
+					except requests.exceptions.HTTPError:
+						self.__DiscoverServices()
+						if self.ServiceUrl(service) == url:
+							Error('Unknown Spectrum service: {0}'.format(service))
+							return None
+						apiManager = APIManager(self.ServiceUrl(service), self.debug, self.wadlCache, self.transport)
+					binding = ServiceBinding(apiManager, resource, self.credentials[0], self.credentials[1], debug=self.debug, transport=self.transport)
+					with self.bindingLock:
+						self.bindings[key] = binding
+		return binding
+
+	def GetBatchBinding(self, service):
+		"""Returns the compiled multi-row binding for the service's XML POST resource. """
+		key = (service, 'batch')
+		binding = self.bindings.get(key)
+		if binding is None:
+			serviceBinding = self.GetServiceBinding(service)
+			if serviceBinding is None:
+				raise KeyError('Unknown Spectrum service: {0}'.format(service))
+			manager = serviceBinding.Manager
+			with self.__BindingLock(key):
+				binding = self.bindings.get(key)
+				if binding is None:
+					resource = None
+					for name in manager.Resources:
+						if manager.Resources[name]['requesttype'].upper() == 'POST' and 'xmlrequest' in manager.Resources[name]:
+							resource = name
+					if resource is None:
+						raise ValueError('Service {0} has no XML POST resource for batch calls'.format(service))
+					binding = BatchBinding(manager, resource, self.credentials[0], self.credentials[1], debug=self.debug, transport=self.transport)
+					with self.bindingLock:
+						self.bindings[key] = binding
+		return binding
+
+	def InvalidateServiceBindings(self, service = None):
+		"""Discards compiled bindings for the service, or for all services, so they are compiled again on next use. """
+		with self.bindingLock:
+			for key in list(self.bindings):
+				if service is None or key[0] == service:
+					self.bindings[key].Manager.Invalidate()
+					del self.bindings[key]
+
+	def AsyncSpectrumServices(self, concurrency = None, limitPerHost = None):
+		"""Returns the asyncio mirror of SpectrumServices, sharing this server's service bindings. Requires aiohttp. concurrency and
+		limitPerHost (default 100) size its connection pool when it is created, later calls must not ask for other limits. Use it
+		as 'async with' or await its close() before the event loop ends. """
+		if self.asyncSpectrumServices == None:
+			from .asyncclient import AsyncTransport, AsyncSpectrumServices
+			transport = AsyncTransport(self.credentials, concurrency=100 if concurrency is None else concurrency,
+				limitPerHost=100 if limitPerHost is None else limitPerHost, metrics=self.transport.metrics)
+			self.asyncSpectrumServices = AsyncSpectrumServices(self, transport)
+		transport = self.asyncSpectrumServices.transport
+		if (concurrency is not None and concurrency != transport.concurrency) or (limitPerHost is not None and limitPerHost != transport.limitPerHost):
+			raise ValueError('The asyncio services of this server already use concurrency {0} and limitPerHost {1}'.format(transport.concurrency, transport.limitPerHost))
+		return self.asyncSpectrumServices
+
+	def Metrics(self):
+		"""Returns the CallMetrics registry recording the calls of this server. """
+		return self.transport.metrics
 
-			#
-			# Define SpectrumServices class using META programming.
-			#
-			class SpectrumServices:
-				
-				def __init__ (self, doDebug):
-					self.debug = doDebug
-					self.Apis = {}
-					self.ApiHelps = {}
-					
-					for service in innerSelf.Services:
-						try:
-							@createFuction(service)
-							def api(args, kwargs, service):
-								api_url = innerSelf.Services[service]
-								# APIManager for this URL (rest service) is where the wadl document is actually fetched and parsed
-								apiManager = APIManager(api_url, self.debug)
-								# GetConnection is where the supplied args are formatted into a request URL and opened
-								self.connection = apiManager.GetConnection(innerSelf.credentials[0], innerSelf.credentials[1])	
-								response = self.connection.results_json_GET(**kwargs)
-								if not response is None:
-									response = response.decode('utf-8')
-									if (self.debug == True):
-										print (response)
-								return response
-								
-							@createHelpFuction(service)
-							def apiHelp(service):
-								api_url = innerSelf.Services[service]
-								# APIManager for this URL (rest service) is where the wadl document is actually fetched and parsed
-								apiManager = APIManager(api_url, self.debug)
-								apiManager.DisplayHelp()	
-								
-							self.__dict__[service]=api
-							self.__dict__['Help_'+service]=apiHelp
-							self.Apis[service] = api
-							self.ApiHelps[service] = apiHelp
-						except:
-							# TODO: Some WADLs are more complex - e.g. Spatial is the wadl for Spectrum Spatial rest services
-							pass
-
-				def Help(self, service):
-					self.__dict__['Help_'+service]()
-
-			self.spectrumServices = SpectrumServices(self.debug)
-			
-		return self.spectrumServices
-		
 	def url(self):
 		return self.url
 		
-	def get(self, path):
+	def get(self, path, stream = False):
 		try:
-			response = requests.get(self.url+path, auth=self.credentials)
+			response = self.transport.get(self.url+path, stream=stream)
 			return response
 		except requests.exceptions.RequestException as e:
 			print (e)
 
 	def getSoapService(self, wsdl):
-		session = requests.Session()
-		session.auth = requests.auth.HTTPBasicAuth(self.credentials[0], self.credentials[1])
-		soapService = zeep.Client(self.url+wsdl, transport=zeep.Transport(session=session))
+		"""Returns the zeep client for the WSDL path, built on first use and shared afterwards. The WSDL and XSD documents are
+		kept in the WadlCache's SOAP cache, so a new process with a cache directory does not download them again. """
+		soapService = self.soapServices.get(wsdl)
+		if soapService is None:
+			with self.soapLock:
+				soapService = self.soapServices.get(wsdl)
+				if soapService is None:
+					# The zeep transport reuses the pooled session, which already carries the Authorization header
+					timeout = self.transport.timeout[1] if isinstance(self.transport.timeout, tuple) else self.transport.timeout
+					wadlCache = WadlCache.Default() if self.wadlCache is None else self.wadlCache
+					cache = wadlCache.SoapCache() if wadlCache else None
+					# zeep sets its own User-Agent on the session it is given, put back the one the REST calls send
+					session = self.transport.session
+					userAgent = session.headers.get('User-Agent')
+					soapTransport = zeep.Transport(cache=cache, session=session, timeout=timeout, operation_timeout=timeout)
+					if userAgent is None:
+						session.headers.pop('User-Agent', None)
+					else:
+						session.headers['User-Agent'] = userAgent
+					soapService = zeep.Client(self.url+wsdl, transport=soapTransport)
+					self.soapServices[wsdl] = soapService
 		return soapService
 	
 
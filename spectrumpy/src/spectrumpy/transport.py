@@ -0,0 +1,142 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import time
+import base64
+import functools
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from .metrics import CallMetrics, ServiceName, ResetConnectTime, ConnectTime, connectTimer
+
+__all__ = ['Transport', 'BasicAuthHeader']
+
+@functools.lru_cache(maxsize=64)
+def BasicAuthHeader(username, password):
+	"""Returns the value of a Basic Authorization header, computed once per credential pair. """
+	return 'Basic ' + base64.b64encode('{0}:{1}'.format(username, password).encode()).decode()
+
+#
+# Connection classes recording the time spent establishing connections on the calling thread.
+#
+
+class TimedHTTPConnection(HTTPConnection):
+	def connect(self):
+		start = time.perf_counter()
+		try:
+			super().connect()
+		finally:
+			connectTimer.seconds = ConnectTime() + time.perf_counter() - start
+
+class TimedHTTPSConnection(HTTPSConnection):
+	def connect(self):
+		start = time.perf_counter()
+		try:
+			super().connect()
+		finally:
+			connectTimer.seconds = ConnectTime() + time.perf_counter() - start
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+	ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+	ConnectionCls = TimedHTTPSConnection
+
+TIMED_POOL_CLASSES = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+class TimedSession(requests.Session):
+	"""Session recording the connect, time to first byte, download and total time of every request in a CallMetrics registry.
+	This includes the SOAP calls zeep sends through the session. Streamed responses are recorded when they are closed. """
+
+	def __init__(self, metrics):
+		super().__init__()
+		self.metrics = metrics
+
+	def request(self, method, url, *args, **kwargs):
+		ResetConnectTime()
+		start = time.perf_counter()
+		try:
+			response = super().request(method, url, *args, **kwargs)
+		except requests.exceptions.RequestException as e:
+			self.metrics.Record(ServiceName(url), {'connect':ConnectTime(), 'total':time.perf_counter() - start}, error=str(e), url=url)
+			raise
+		connect = ConnectTime()
+		headers = response.elapsed.total_seconds()
+		body = response.request.body
+		bytesSent = 0 if body is None else len(body) if isinstance(body, (bytes, str)) else 0
+		error = None if response.ok else '{0} {1}'.format(response.status_code, response.reason)
+
+		def record(download, bytesReceived):
+			phases = {'connect':connect, 'ttfb':max(headers - connect, 0.0), 'download':download, 'total':time.perf_counter() - start}
+			self.metrics.Record(ServiceName(url), phases, bytesSent, bytesReceived, error, url)
+
+		if not kwargs.get('stream'):
+			record(max(time.perf_counter() - start - headers, 0.0), len(response.content))
+			return response
+
+		#
+		# The body of a streamed response is read by the caller, record the call once the response is closed.
+		#
+
+		close = response.close
+		def closeAndRecord():
+			if response.__dict__.pop('close', None) is not None:
+				record(max(time.perf_counter() - start - headers, 0.0), response.raw.tell() if response.raw is not None else 0)
+			close()
+		response.close = closeAndRecord
+		return response
+
+class Transport:
+	"""Pooled keep-alive HTTP transport shared by all REST, FeatureService and SOAP calls to a Spectrum server. """
+
+	default = None
+
+	def __init__(self, credentials = None, poolConnections = 10, poolMaxSize = 10, poolBlock = False, timeout = (10, 300), maxRetries = 0, metrics = None):
+		''' Constructor for this class. poolMaxSize limits the kept-alive connections per host, poolBlock makes it a hard limit.
+		Calls are recorded in metrics, None uses the process wide CallMetrics. '''
+		self.timeout = timeout
+		self.poolMaxSize = poolMaxSize
+		self.metrics = CallMetrics.Default() if metrics is None else metrics
+		self.session = TimedSession(self.metrics)
+		self.adapter = HTTPAdapter(pool_connections=poolConnections, pool_maxsize=poolMaxSize, pool_block=poolBlock, max_retries=maxRetries)
+		self.adapter.poolmanager.pool_classes_by_scheme = TIMED_POOL_CLASSES
+		self.session.mount('http://', self.adapter)
+		self.session.mount('https://', self.adapter)
+
+		#
+		# Precompute the Authorization header, it is then sent with every request of the session.
+		#
+
+		if credentials is not None:
+			self.session.headers['Authorization'] = BasicAuthHeader(credentials[0], credentials[1])
+
+	def Default():
+		"""Returns the process wide transport used when no server transport is supplied. """
+		if Transport.default is None:
+			Transport.default = Transport()
+		return Transport.default
+
+	def request(self, method, url, data = None, headers = None, stream = False, timeout = None):
+		"""Sends the request over a pooled connection and returns the requests response. """
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		return self.session.request(method, url, data=data, headers=headers, stream=stream, timeout=self.timeout if timeout is None else timeout)
+
+	def get(self, url, headers = None, stream = False, timeout = None):
+		"""Sends a GET request over a pooled connection and returns the requests response. """
+		return self.request('GET', url, headers=headers, stream=stream, timeout=timeout)
+
+	def close(self):
+		"""Closes all pooled connections. """
+		self.session.close()
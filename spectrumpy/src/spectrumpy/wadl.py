@@ -0,0 +1,193 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import io
+import re
+from lxml import etree
+
+__all__ = ['WadlParser', 'ParseServiceIndex']
+
+XS_NAMESPACE = 'http://www.w3.org/2001/XMLSchema'
+
+def LocalName(tag):
+	"""Returns the tag without its namespace. """
+	return tag.rpartition('}')[2]
+
+def IterElements(content, events = ('start', 'end'), **options):
+	"""Yields iterparse (event, element) pairs for a document in bytes or str. Each element is cleared after its end event, with
+	the siblings before it, so only the path to the current element stays in memory. """
+	if isinstance(content, str):
+		content = content.encode('utf-8')
+	for event, element in etree.iterparse(io.BytesIO(content), events=events, **options):
+		yield event, element
+		if event == 'end':
+			element.clear(keep_tail=True)
+			parent = element.getparent()
+			if parent is not None:
+				while element.getprevious() is not None:
+					del parent[0]
+
+class WadlParser:
+	"""Streaming parser of a Spectrum WADL document and the XSD grammars it includes into the APIManager resource model.
+	Elements are dispatched to tag handlers from iterparse events, the enclosing URL, method and type are kept on a stack. """
+
+	def __init__(self, url, fetch = None, debug = False):
+		''' Constructor for this class. fetch(url) returns the content of an included grammar, None skips grammars. '''
+		self.Url = url
+		self.Fetch = fetch
+		self.debug = debug
+		self.Resources = {}
+		self.Objects = {}
+		self.base = None
+		# WADL handlers by local name, they update the scope of the element and its descendants
+		self.handlers = {
+			'include':self.__Include,
+			'resources':self.__Resources,
+			'resource':self.__Resource,
+			'method':self.__Method,
+			'representation':self.__Representation,
+			'param':self.__Param
+		}
+		# XSD handlers, they return the complex type of the element and its descendants
+		self.grammarHandlers = {
+			'{' + XS_NAMESPACE + '}complexType':self.__ComplexType,
+			'{' + XS_NAMESPACE + '}attribute':self.__Attribute,
+			'{' + XS_NAMESPACE + '}extension':self.__Extension,
+			'{' + XS_NAMESPACE + '}element':self.__Element
+		}
+
+	def Parse(self, content):
+		"""Parses the WADL document and its grammars into Resources and Objects, returns (Resources, Objects). """
+		scopes = [{'tag':None, 'url':None, 'api':None}]
+		for event, element in IterElements(content):
+			if event == 'start':
+				parent = scopes[-1]
+				scope = dict(parent)
+				scope['tag'] = LocalName(element.tag)
+				handler = self.handlers.get(scope['tag'])
+				if handler is not None:
+					handler(element, scope, parent)
+				scopes.append(scope)
+			else:
+				scopes.pop()
+		return self.Resources, self.Objects
+
+	def ParseGrammar(self, content):
+		"""Parses the complex types of an XSD grammar into Objects. """
+		types = [None]
+		for event, element in IterElements(content):
+			if event == 'start':
+				complexType = types[-1]
+				handler = self.grammarHandlers.get(element.tag)
+				if handler is not None:
+					complexType = handler(element, complexType)
+				types.append(complexType)
+			else:
+				types.pop()
+		return self.Objects
+
+	#
+	# WADL handlers.
+	#
+
+	def __Include(self, element, scope, parent):
+		# The include node references the grammar, which contains the object definitions
+		if self.Fetch is not None:
+			grammarhref = re.sub(r'[^/]+\Z', '', self.Url) + element.get('href')
+			self.ParseGrammar(self.Fetch(grammarhref))
+
+	def __Resources(self, element, scope, parent):
+		self.base = scope['url'] = re.sub(r'/\Z', '', element.get('base'))
+
+	def __Resource(self, element, scope, parent):
+		scope['url'] = (scope['url'] or '') + element.get('path')
+
+	def __Method(self, element, scope, parent):
+		requestType = element.get('name')
+		method = re.sub(r'(\A/)|(/\Z)', '', scope['url'].replace(self.base, ''))
+		method = '{0}_{1}'.format(re.sub('/', '_', method), requestType)
+		scope['api'] = method.replace('.','_')
+		if (self.debug == True):
+			print ('   Processing method: {0}, apiName: {1}, method: {2}, requestType: {3}'.format(requestType, scope['api'], method, requestType))
+		self.Resources[scope['api']] = {'requesttype':requestType, 'contentType':'application/xml', 'method':method, 'url':scope['url'], 'params':{}}
+
+	def __Representation(self, element, scope, parent):
+		# Request and response representations give the object types of the XML call
+		mediaType = element.get('mediaType')
+		if scope['api'] is None:
+			return
+		if mediaType is not None:
+			self.Resources[scope['api']]['contentType'] = mediaType
+		if element.get('element') is not None and mediaType == 'application/xml':
+			if parent['tag'] == 'request':
+				self.Resources[scope['api']]['xmlrequest'] = element.get('element')
+			else:
+				self.Resources[scope['api']]['xmlresponse'] = element.get('element')
+
+	def __Param(self, element, scope, parent):
+		if scope['api'] is None:
+			return
+		name = element.get('name')
+		typeA = element.get('type')
+		arg = name.replace(".", "_")
+		if (self.debug == True):
+			print ('      Parameter {0}, name: {1}, type: {2}'.format(arg, name, typeA))
+		self.Resources[scope['api']]['params'][arg] = {'name':name, 'type':typeA}
+
+	#
+	# XSD handlers.
+	#
+
+	def __ComplexType(self, element, complexType):
+		name = element.get('name')
+		if name is None:
+			# Anonymous types belong to the enclosing named type
+			return complexType
+		self.Objects[name] = {'attributes':[], 'bases':[], 'elements':[], 'elementTypes':{}, 'repeated':[]}
+		return name
+
+	def __Attribute(self, element, complexType):
+		if complexType is not None and element.get('name') is not None:
+			self.Objects[complexType]['attributes'].append(element.get('name'))
+		return complexType
+
+	def __Extension(self, element, complexType):
+		# Extension objects are inherited objects
+		if complexType is not None:
+			self.Objects[complexType]['bases'].append(re.sub(r'tns\:', '', element.get('base')))
+		return complexType
+
+	def __Element(self, element, complexType):
+		name = element.get('name')
+		if complexType is None or name is None:
+			return complexType
+		self.Objects[complexType]['elements'].append(name)
+		if element.get('type') is not None:
+			self.Objects[complexType]['elementTypes'][name] = re.sub(r'\A[^:]*:', '', element.get('type'))
+		maxOccurs = element.get('maxOccurs', '')
+		if maxOccurs == 'unbounded' or (maxOccurs.isdigit() and int(maxOccurs) > 1):
+			self.Objects[complexType]['repeated'].append(name)
+		return complexType
+
+def ParseServiceIndex(content, url, encoding = None, debug = False):
+	"""Returns service name => WADL URL from the links of the Spectrum /rest index page. The page is not well formed XML, it is
+	read with the recovering HTML parser. """
+	services = {}
+	for event, element in IterElements(content, ('end',), tag='a', html=True, encoding=encoding):
+		for text in [element.text] + [child.tail for child in element]:
+			if text is not None and text.endswith('?_wadl'):
+				service_name = text.replace(url + 'rest/','').replace('?_wadl','')
+				if (debug == True):
+					print ('Service {0} : {1}'.format(service_name, text))
+				services[service_name] = text
+	return services
@@ -13,7 +13,12 @@ setup(name='spectrumspatialpy',
             'spectrumpy',
             'pandas',
             'geopandas',
+            'shapely>=2.0',
+            'numpy',
             'colour',
             'datetime'
       ],
+      extras_require={
+            'export': ['pyarrow', 'pyogrio']
+      },
       zip_safe=False)
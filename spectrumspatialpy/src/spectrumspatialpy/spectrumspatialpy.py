@@ -11,16 +11,37 @@
 # permissions and limitations under the License.
 #
 #
-import requests
-import lxml
+import os
+import time
 import urllib
 from urllib.parse import quote
 import spectrumpy
 import json
-import shapely
-import pandas as pd
-import geopandas as gpd
-import colour
+import marshal
+import math
+import collections
+import hashlib
+import re
+import tempfile
+import threading
+import zlib
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+from spectrumpy.lazy import LazyImport
+
+#
+# Heavy dependencies are imported on first use, so scripts that only list tables or call services do not load pandas and geopandas.
+#
+
+requests = LazyImport('requests', globals())
+etree = LazyImport('lxml.etree', globals())
+np = LazyImport('numpy', globals(), 'np')
+shapely = LazyImport('shapely', globals())
+pd = LazyImport('pandas', globals(), 'pd')
+gpd = LazyImport('geopandas', globals(), 'gpd')
+colour = LazyImport('colour', globals())
+zeep = LazyImport('zeep', globals())
 
 class SpatialServer:
 	def __init__(self, spectrum):
@@ -51,12 +72,55 @@ class SpatialServer:
 		"""Return the Thematics Service for this server. """
 		return self.thematics
 
+class Mxp:
+	"""Builds MXP named resource documents as lxml trees in one pass. Text and attribute values are escaped by lxml. """
+
+	NAMESPACE='http://www.mapinfo.com/mxp'
+	GML_NAMESPACE='http://www.opengis.net/gml'
+
+	def document(tag, prefixed=True, attributes=None):
+		"""Returns the root element of a MXP document, with the mxp and gml prefixes or the MXP namespace as default namespace. """
+		nsmap = {'mxp':Mxp.NAMESPACE, 'gml':Mxp.GML_NAMESPACE} if prefixed else {None:Mxp.NAMESPACE}
+		root = etree.Element('{' + Mxp.NAMESPACE + '}' + tag, nsmap=nsmap)
+		root.set('version', 'MXP_NamedResource_1_5')
+		for name, value in (attributes or {}).items():
+			root.set(name, str(value))
+		return root
+
+	def element(parent, tag, attributes=None, text=None, namespace=None):
+		"""Appends an element in the MXP namespace (or the given one) with attributes and text, and returns it. """
+		element = etree.SubElement(parent, '{' + (Mxp.NAMESPACE if namespace is None else namespace) + '}' + tag)
+		for name, value in (attributes or {}).items():
+			element.set(name, str(value))
+		if text is not None:
+			element.text = str(text)
+		return element
+
+	def area_style(parent, stroke, width, pen, fill_opacity, brush, adjustments):
+		"""Appends the CompositeStyle/AreaStyle of a theme bin, adjustments are (color-1, color-2) pairs. """
+		area = Mxp.element(Mxp.element(parent, 'CompositeStyle'), 'AreaStyle')
+		line = Mxp.element(area, 'LineStyle', {'stroke':stroke, 'width':width, 'width-unit':'mapinfo:imagesize pixel'})
+		Mxp.element(line, 'Pen', text=pen)
+		interior = Mxp.element(area, 'Interior', {'fill':'(#id1)', 'fill-opacity':fill_opacity})
+		bitmap = Mxp.element(Mxp.element(Mxp.element(interior, 'Defs'), 'Pattern', {'id':'id1'}), 'Bitmap', {'uri':brush})
+		colors = Mxp.element(bitmap, 'ColorAdjustmentSet')
+		for color1, color2 in adjustments:
+			Mxp.element(colors, 'ColorAdjustment', {'color-1':color1, 'color-2':color2})
+		return area
+
 class NamedResourceService:
 	def __init__(self, spatialserver, spectrum):
 		''' Constructor for this class. '''
 		self.spatialserver=spatialserver
 		self.spectrum=spectrum
-		self.service=self.spectrum.getSoapService("soap/NamedResourceService?wsdl")
+		# Listed path => set of resource paths below it, kept up to date by our own adds
+		self.index={}
+		self.indexLock=threading.Lock()
+
+	@property
+	def service(self):
+		"""The zeep client of the service, built by the server on first use. """
+		return self.spectrum.getSoapService("soap/NamedResourceService?wsdl")
 
 	def listNamedResources(self, path):
 		"""Lists the named resosurces at this server within the specified path. Use '/'for the root to return all resources. """
@@ -76,14 +140,84 @@ class NamedResourceService:
 		return False
 
 	def upsert(self, path, name, sz_resource):
-		"""Inserts or updates the named resource with the specified contents. """
-		resource = lxml.etree.fromstring(sz_resource)
+		"""Inserts or updates the named resource with the specified contents, an XML string or bytes or an lxml element. """
+		resource = sz_resource if etree.iselement(sz_resource) else etree.fromstring(sz_resource)
 		if self.does_exist(path, name):
 			#Update
 			self.service.service.updateNamedResource(Resource=resource, Path=path + "/" + name)
 		else:
 			#Add
 			self.service.service.addNamedResource(Resource=resource, Path=path + "/" + name)
+			self.__indexed(path, path + "/" + name)
+		# Cached query pages of the resource are stale now
+		self.spatialserver.FeatureService().invalidateCache(path + "/" + name)
+
+	def __existing(self, path):
+		with self.indexLock:
+			existing = self.index.get(path)
+		if existing is None:
+			try:
+				existing = set([resource["Path"] for resource in (self.listNamedResources(path) or [])])
+			except zeep.exceptions.Fault as fault:
+				# Only a path that does not exist yet is known to be empty, other faults are not remembered
+				if not re.search(r'not (exist|found)', str(fault.message), re.I):
+					raise
+				existing = set()
+			with self.indexLock:
+				existing = self.index.setdefault(path, existing)
+		return existing
+
+	def __prefetch(self, path):
+		try:
+			self.__existing(path)
+		except Exception:
+			# The resources below the path list it again and report the error
+			pass
+
+	def __indexed(self, path, resourcePath):
+		with self.indexLock:
+			for listed, existing in self.index.items():
+				if path == listed or path.startswith(listed.rstrip('/') + '/'):
+					existing.add(resourcePath)
+
+	def invalidateIndex(self, path=None):
+		"""Forgets the listing of the path, or of all paths, so upsert_many lists it again. """
+		with self.indexLock:
+			if path is None:
+				self.index={}
+			else:
+				self.index.pop(path, None)
+
+	def upsert_many(self, resources, workers=4, progress=None):
+		"""Inserts or updates many named resources. resources is an iterable of (path, name, resource) tuples or of dicts with
+		'path', 'name' and 'resource' keys, a resource is an XML string or bytes or an lxml element. Each path is listed once and
+		remembered, the adds and updates run on a pool of workers. Returns a spectrumpy BatchResult per resource, in input order,
+		with output 'added' or 'updated' or the error. """
+		rows = [dict(row) if isinstance(row, dict) else {'path':row[0], 'name':row[1], 'resource':row[2]} for row in resources]
+		paths = list(dict.fromkeys([row['path'] for row in rows]))
+		with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths)))) as executor:
+			list(executor.map(self.__prefetch, paths))
+
+		#
+		# The same resource may appear more than once, serialize its writes so the first one adds and later ones update.
+		#
+
+		locks = {row['path'] + '/' + row['name']:threading.Lock() for row in rows}
+		def write(row):
+			path = row['path']
+			resourcePath = path + '/' + row['name']
+			resource = row['resource'] if etree.iselement(row['resource']) else etree.fromstring(row['resource'])
+			with locks[resourcePath]:
+				if resourcePath in self.__existing(path):
+					self.service.service.updateNamedResource(Resource=resource, Path=resourcePath)
+					action = 'updated'
+				else:
+					self.service.service.addNamedResource(Resource=resource, Path=resourcePath)
+					self.__indexed(path, resourcePath)
+					action = 'added'
+			self.spatialserver.FeatureService().invalidateCache(resourcePath)
+			return action
+		return list(spectrumpy.BatchRun(write, rows, workers=workers, progress=progress))
 		
 class FeatureService:
 	def __init__(self, spatialserver, spectrum):
@@ -91,6 +225,22 @@ class FeatureService:
 		self.spatialserver=spatialserver
 		self.spectrum=spectrum
 		self.service='rest/Spatial/FeatureService'
+		self.cache=None
+
+	def enableCache(self, maxEntries=256, maxBytes=256*1024*1024, ttl=300, directory=None):
+		"""Caches query pages in a bounded LRU, and on disk when a directory is given. Returns the QueryCache. Pages are kept apart per
+		server and user, so services of other servers or users can share the directory. """
+		self.cache=QueryCache(maxEntries, maxBytes, ttl, directory, scope=(self.spectrum.url, self.spectrum.credentials[0]))
+		return self.cache
+
+	def disableCache(self):
+		"""Stops caching query pages. """
+		self.cache=None
+
+	def invalidateCache(self, table=None):
+		"""Drops cached pages of queries referencing the table path, or all cached pages. """
+		if self.cache is not None:
+			self.cache.invalidate(table)
 
 	def listTables(self):
 		try:
@@ -127,26 +277,25 @@ class FeatureService:
 			print (e)
 
 	def createViewTable(self, query, path, viewName, refTables):
-		sz=''
-		sz=sz+'<NamedDataSourceDefinition version="MXP_NamedResource_1_5" xmlns="http://www.mapinfo.com/mxp" >'
-		sz=sz+'	<ConnectionSet/>'
-		sz=sz+'	<DataSourceDefinitionSet>'
+		self.spatialserver.NamedResourceService().upsert(path,viewName,self.viewTableDocument(query, viewName, refTables))
+
+	def viewTableDocument(self, query, viewName, refTables):
+		"""Returns the MXP NamedDataSourceDefinition of a MapInfo SQL view as an lxml element. """
+		root = Mxp.document('NamedDataSourceDefinition', prefixed=False)
+		Mxp.element(root, 'ConnectionSet')
+		sources = Mxp.element(root, 'DataSourceDefinitionSet')
 		if refTables is not None:
 			for refTable in refTables:
-				sz=sz+'    <NamedDataSourceDefinitionRef id="id2" resourceID="'+refTable+'"/>	'
-		sz=sz+'	<MapinfoSQLDataSourceDefinition id="id3" readOnly="true">'
-		sz=sz+'			<DataSourceName>'+viewName+'</DataSourceName>'
-		sz=sz+'			<MapinfoSQLQuery>'
-		sz=sz+'				<Query>'+query+'</Query>'
-		sz=sz+'			</MapinfoSQLQuery>'
-		sz=sz+'	</MapinfoSQLDataSourceDefinition>'
-		sz=sz+'	</DataSourceDefinitionSet>'
-		sz=sz+'	<DataSourceRef ref="id3"/>'
-		sz=sz+'</NamedDataSourceDefinition>'
-		self.spatialserver.NamedResourceService().upsert(path,viewName,sz)
-	
-	
-	def query(self, q, debug=False, pageLength=0):
+				Mxp.element(sources, 'NamedDataSourceDefinitionRef', {'id':'id2', 'resourceID':refTable})
+		definition = Mxp.element(sources, 'MapinfoSQLDataSourceDefinition', {'id':'id3', 'readOnly':'true'})
+		Mxp.element(definition, 'DataSourceName', text=viewName)
+		Mxp.element(Mxp.element(definition, 'MapinfoSQLQuery'), 'Query', text=query)
+		Mxp.element(root, 'DataSourceRef', {'ref':'id3'})
+		return root
+
+
+	def query(self, q, debug=False, pageLength=0, prefetch=0):
+		"""Runs the MapInfo SQL query. With a pageLength pages are iterated, prefetch keeps that many page requests in flight. """
 	
 		class FeatureStream:
 			
@@ -173,7 +322,7 @@ class FeatureService:
 					self.iter_numReturned = 0
 					done=False
 					while not done:
-						self.iter_numReturned=0
+						numReturned=0
 						done=True
 						url = self.service + '/tables/features.json?'
 						if self.pglen > 0:
@@ -181,13 +330,20 @@ class FeatureService:
 						url = url +'q=' + self.q
 						if self.debug:
 							print (url)
-						response = self.spectrum.get(url)
-						fc = response.json()
+						fc = None if queryCache is None else queryCache.get(q, self.pglen, self.pageNum)
 						if fc is None:
-							fc = {'features':[]}
-						if 'features' not in fc:
-							fc['features']=[]
-						self.iter_numReturned+=len(fc['features'])
+							response = self.spectrum.get(url)
+							startTime = time.perf_counter()
+							fc = response.json()
+							self.spectrum.Metrics().Observe(spectrumpy.ServiceName(url), 'parse', time.perf_counter() - startTime)
+							if fc is None:
+								fc = {'features':[]}
+							if 'features' not in fc:
+								fc['features']=[]
+							if queryCache is not None:
+								queryCache.put(q, self.pglen, self.pageNum, fc)
+						numReturned=len(fc['features'])
+						self.iter_numReturned+=numReturned
 						if self.first:
 							self.first=False
 							self.featureCollection=fc
@@ -196,7 +352,7 @@ class FeatureService:
 						else:
 							for feature in fc['features']:
 								self.featureCollection['features'].append(feature)
-						if self.iter_numReturned == self.pglen and not self.paging:
+						if numReturned == self.pglen and not self.paging:
 							self.pageNum+=1
 							done=False
 				except requests.exceptions.RequestException as e:  # This is the correct syntax
@@ -217,6 +373,12 @@ class FeatureService:
 		paging = pageLength > 0
 		if pageLength == 0:
 			pageLength = 1000
+		queryCache = self.cache
+		if prefetch > 0:
+			reader = FeaturePageReader(self.spectrum, self.service, q, pageLength, prefetch, debug, cache=queryCache)
+			if paging:
+				return reader
+			return reader.collect()
 		fs = FeatureStream(self.service, self.spatialserver, self.spectrum, urllib.parse.quote(q), pageLength, paging, debug)
 		if not paging:
 			fc = fs.__next__()
@@ -224,6 +386,179 @@ class FeatureService:
 		else:
 			return fs
 			
+	# Aggregate functions of MapInfo SQL accepted by aggregate()
+	AGGREGATE_FUNCTIONS = ('Count', 'Sum', 'Avg', 'Min', 'Max')
+
+	def aggregateSql(self, table, group_by, aggregates=None, where=None):
+		"""Returns the MapInfo SQL GROUP BY query run by aggregate(). """
+		groups = [group_by] if isinstance(group_by, str) else list(group_by)
+		columns = [FeatureService.__identifier(group) for group in groups]
+		for alias, (function, column) in FeatureService.__aggregates(aggregates).items():
+			columns.append('{0}({1}) AS {2}'.format(function, '*' if column == '*' else FeatureService.__identifier(column), FeatureService.__identifier(alias)))
+		sql = 'SELECT ' + ', '.join(columns) + ' FROM "' + table + '"'
+		if where:
+			sql += ' WHERE ' + where
+		return sql + ' GROUP BY ' + ', '.join([FeatureService.__identifier(group) for group in groups])
+
+	def aggregate(self, table, group_by, aggregates=None, where=None, debug=False):
+		"""Aggregates the table on the server with a GROUP BY query that returns no geometry. aggregates maps result names to
+		(function, column) pairs, e.g. {'population':('Sum', 'Pop_2020')}, the default is {'feature_count':('Count', '*')}. Returns a Series indexed
+		by the group_by values for a single aggregate, usable as lookup_table or data_series of the Thematics functions, otherwise a DataFrame. """
+		aggregates = FeatureService.__aggregates(aggregates)
+		fc = self.query(self.aggregateSql(table, group_by, aggregates, where), debug)
+		groups = [group_by] if isinstance(group_by, str) else list(group_by)
+		rows = [] if fc is None else [feature['properties'] for feature in fc['features']]
+		frame = pd.DataFrame(rows, columns=groups + list(aggregates))
+		for alias in aggregates:
+			frame[alias] = pd.to_numeric(frame[alias], errors='coerce')
+		frame = frame.set_index(groups[0] if len(groups) == 1 else groups)
+		if len(aggregates) == 1:
+			return frame[list(aggregates)[0]]
+		return frame
+
+	def __aggregates(aggregates):
+		if aggregates is None:
+			return {'feature_count':('Count', '*')}
+		for alias, (function, column) in aggregates.items():
+			if function.capitalize() not in FeatureService.AGGREGATE_FUNCTIONS:
+				raise ValueError('Unsupported aggregate function ' + function + ', use one of ' + ', '.join(FeatureService.AGGREGATE_FUNCTIONS))
+		return aggregates
+
+	def __identifier(name):
+		if re.match(r'^[A-Za-z_]\w*$', name):
+			return name
+		return '"' + name.replace('"', '""') + '"'
+
+	def features(self, q, pageLength=1000, debug=False):
+		"""Yields the features of the query one at a time, parsing each page incrementally as it downloads. """
+		reader = FeaturePageReader(self.spectrum, self.service, q, pageLength, 1, debug)
+		pageNum = 1
+		while True:
+			response = self.spectrum.get(reader.pageUrl(pageNum), stream=True)
+			if response is None:
+				return
+			numReturned = 0
+			with response:
+				for feature in FeatureJSONStream(response.iter_content(chunk_size=65536)):
+					numReturned += 1
+					yield feature
+			if numReturned < pageLength:
+				return
+			pageNum += 1
+
+	def query_frames(self, q, chunk_rows=1000, prefetch=2, debug=False, stream=False):
+		"""Yields the query result as GeoDataFrame chunks of up to chunk_rows rows with the schema and CRS of the first chunk.
+		Pages are prefetched so the conversion of one chunk overlaps the download of the next. With stream pages are parsed
+		incrementally into column buffers, so a page never exists as a full FeatureCollection. """
+		geometry = self.spatialserver.GeometryOperations()
+		columns = None
+		dtypes = None
+		offset = 0
+		reader = FeaturePageReader(self.spectrum, self.service, q, chunk_rows, prefetch, debug, stream, self.cache)
+		for page in reader:
+			startTime = time.perf_counter()
+			frame = page.ToGeoDataFrame(geometry) if stream else geometry.GeoJSON2GeoDataFrame(page)
+			reader.metrics.Observe(reader.label, 'convert', time.perf_counter() - startTime)
+			if len(frame) == 0:
+				continue
+
+			#
+			# Conform every chunk to the columns and types of the first one.
+			#
+
+			if columns is None:
+				columns = list(frame.columns)
+				dtypes = frame.dtypes
+			else:
+				frame = frame.reindex(columns=columns)
+				for column in columns:
+					if frame[column].dtype != dtypes[column] and column != 'geometry':
+						try:
+							frame[column] = frame[column].astype(dtypes[column])
+						except (ValueError, TypeError):
+							pass
+				if 'geometry' in columns:
+					frame = gpd.GeoDataFrame(frame, geometry='geometry', crs='EPSG:4326')
+			frame.index = pd.RangeIndex(offset, offset + len(frame))
+			offset += len(frame)
+			yield frame
+
+	# File extension => export format
+	EXPORT_FORMATS = {'.parquet':'GeoParquet', '.geoparquet':'GeoParquet', '.fgb':'FlatGeobuf', '.gpkg':'GPKG'}
+
+	def export(self, q, path, format=None, layer=None, chunk_rows=10000, prefetch=2, debug=False, stream=False):
+		"""Streams the query result into a GeoParquet, FlatGeobuf or GeoPackage file, page by page. The file is written next to path
+		and replaces it only once complete, a failed query or write leaves an existing file as it was. Returns a dict with rows, chunks, seconds, rowsPerSecond and bytesWritten. Requires pyarrow (and pyogrio for OGR formats). """
+		import pyarrow as pa
+		if format is None:
+			format = FeatureService.EXPORT_FORMATS.get(os.path.splitext(path)[1].lower())
+		if format not in ('GeoParquet', 'FlatGeobuf', 'GPKG'):
+			raise ValueError('Unknown export format for ' + path + ', use GeoParquet, FlatGeobuf or GPKG')
+
+		stats = {'rows':0, 'chunks':0, 'seconds':0.0, 'rowsPerSecond':0.0, 'bytesWritten':0}
+		startTime = time.perf_counter()
+		frames = self.query_frames(q, chunk_rows=chunk_rows, prefetch=prefetch, debug=debug, stream=stream)
+		first = next(frames, None)
+		if first is None:
+			# The query ran and found nothing, an older export of it is stale
+			if os.path.exists(path):
+				os.remove(path)
+			return stats
+		hasGeometry = 'geometry' in first.columns
+		schema = FeatureService.__arrow_table(first, hasGeometry).schema
+		if hasGeometry and format == 'GeoParquet':
+			geo = {'version':'1.0.0', 'primary_column':'geometry', 'columns':{'geometry':{'encoding':'WKB', 'geometry_types':[], 'crs':first.crs.to_json_dict()}}}
+			schema = schema.with_metadata({b'geo':json.dumps(geo).encode('utf-8')})
+
+		#
+		# Each chunk becomes a record batch (a row group for GeoParquet) as soon as its page arrives.
+		#
+
+		def batches():
+			for frame in itertools.chain([first], frames):
+				table = FeatureService.__arrow_table(frame, hasGeometry).cast(schema)
+				stats['rows'] += len(frame)
+				stats['chunks'] += 1
+				for batch in table.to_batches():
+					yield batch
+
+		# The writers want to create the file themselves, only its unique name is taken here
+		fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.export-', suffix=os.path.splitext(path)[1])
+		os.close(fd)
+		os.remove(tmpPath)
+		try:
+			if format == 'GeoParquet':
+				import pyarrow.parquet as pq
+				with pq.ParquetWriter(tmpPath, schema) as writer:
+					for batch in batches():
+						writer.write_batch(batch)
+			else:
+				import pyogrio
+				if layer is None:
+					layer = os.path.splitext(os.path.basename(path))[0]
+				reader = pa.RecordBatchReader.from_batches(schema, batches())
+				pyogrio.write_arrow(reader, tmpPath, layer=layer, driver=format, geometry_name='geometry' if hasGeometry else None,
+					geometry_type='Unknown' if hasGeometry else None, crs='EPSG:4326' if hasGeometry else None)
+			os.replace(tmpPath, path)
+		except BaseException:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+			raise
+
+		stats['seconds'] = time.perf_counter() - startTime
+		stats['rowsPerSecond'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+		stats['bytesWritten'] = os.path.getsize(path)
+		if debug:
+			print ('Exported {0} rows in {1} chunks to {2}: {3:.0f} rows/s, {4} bytes'.format(stats['rows'], stats['chunks'], path, stats['rowsPerSecond'], stats['bytesWritten']))
+		return stats
+
+	def __arrow_table(frame, hasGeometry):
+		import pyarrow as pa
+		if not hasGeometry:
+			return pa.Table.from_pandas(pd.DataFrame(frame), preserve_index=False)
+		table = pa.Table.from_pandas(pd.DataFrame(frame.drop(columns='geometry')), preserve_index=False)
+		return table.append_column('geometry', pa.array(shapely.to_wkb(frame.geometry.values), type=pa.binary()))
+
 	def get(self, path):
 		try:
 			response = self.spectrum.get(self.service + path)
@@ -231,102 +566,620 @@ class FeatureService:
 		except requests.exceptions.RequestException as e:
 			print (e)
 
+class FeatureJSONStream:
+	"""Incrementally parses a features.json response from an iterable of byte chunks, yielding one feature at a time.
+	Members other than features are collected in header. """
+
+	# The rest of the buffer after a decoded number, when it could still continue that number
+	NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+
+	def __init__(self, chunks):
+		''' Constructor for this class. '''
+		self.chunks=iter(chunks)
+		self.decoder=json.JSONDecoder()
+		self.textDecoder=codecs.getincrementaldecoder('utf-8')()
+		self.buffer=''
+		self.pos=0
+		self.exhausted=False
+		self.header={}
+
+	def __read(self, minimum=1):
+		"""Appends at least minimum characters to the buffer, returns False when the stream is exhausted. """
+		if self.pos > 65536:
+			self.buffer=self.buffer[self.pos:]
+			self.pos=0
+		added=0
+		while added < minimum and not self.exhausted:
+			try:
+				chunk=next(self.chunks)
+			except StopIteration:
+				self.exhausted=True
+				chunk=b''
+			text=self.textDecoder.decode(chunk, final=self.exhausted)
+			self.buffer+=text
+			added+=len(text)
+		return added > 0
+
+	def __peek(self):
+		"""Skips white space and returns the next character, '' at the end of the stream. """
+		while True:
+			while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+				self.pos+=1
+			if self.pos < len(self.buffer):
+				return self.buffer[self.pos]
+			if not self.__read():
+				return ''
+
+	def __value(self):
+		"""Decodes the next complete JSON value, reading more of the stream until it is complete. """
+		self.__peek()
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buffer, self.pos)
+
+				#
+				# A number followed by nothing but number characters may be cut off at a chunk boundary ("-0" of "-0.0005",
+				# "1" of "1e5"), a literal ending at the end of the buffer may be too.
+				#
+
+				if isinstance(value, (int, float)) and not isinstance(value, bool):
+					truncated = FeatureJSONStream.NUMBER_TAIL.match(self.buffer, end) is not None
+				else:
+					truncated = end == len(self.buffer)
+				if not truncated or self.exhausted:
+					self.pos=end
+					return value
+			except json.JSONDecodeError:
+				if self.exhausted:
+					raise
+			# Read at least as much again as is pending so a large value is not re-parsed once per chunk
+			self.__read(max(1, len(self.buffer) - self.pos))
+
+	def __expect(self, char):
+		if self.__peek() != char:
+			raise ValueError('Invalid features.json: expected ' + char + ' at ' + repr(self.buffer[self.pos:self.pos+40]))
+		self.pos+=1
+
+	def __iter__(self):
+		self.__expect('{')
+		while True:
+			char = self.__peek()
+			if char == '}' or char == '':
+				return
+			if char == ',':
+				self.pos+=1
+				continue
+			key = self.__value()
+			self.__expect(':')
+			if key != 'features':
+				self.header[key] = self.__value()
+				continue
+			if self.__peek() == 'n':
+				self.__value()
+				continue
+
+			#
+			# Emit the members of the features array one at a time.
+			#
+
+			self.__expect('[')
+			while True:
+				char = self.__peek()
+				if char == ']':
+					self.pos+=1
+					break
+				if char == ',':
+					self.pos+=1
+					continue
+				if char == '':
+					raise ValueError('Invalid features.json: unterminated features array')
+				yield self.__value()
+
+class FeatureColumns:
+	"""Column buffers filled one feature at a time, converted to a (Geo)DataFrame without a FeatureCollection. """
+
+	def __init__(self):
+		''' Constructor for this class. '''
+		self.columns={}
+		self.geometries=[]
+
+	def append(self, feature):
+		"""Appends the properties and geometry of one GeoJSON feature. """
+		properties = feature.get('properties') or {}
+		count = len(self.geometries)
+		for name in properties:
+			if name not in self.columns:
+				self.columns[name] = [None] * count
+		for name, values in self.columns.items():
+			values.append(properties.get(name))
+		self.geometries.append(feature.get('geometry'))
+
+	def __len__(self):
+		return len(self.geometries)
+
+	def ToGeoDataFrame(self, geometry):
+		"""Returns a GeoDataFrame, or a DataFrame when the first feature has no geometry, like Geometry.GeoJSON2GeoDataFrame. """
+		if len(self.geometries) == 0:
+			return pd.DataFrame([], columns=[])
+		frame = pd.DataFrame(self.columns)
+		if self.geometries[0] is None:
+			return frame
+		keep = np.fromiter((g is not None for g in self.geometries), dtype=bool, count=len(self.geometries))
+		geometries = [g for g in self.geometries if g is not None]
+		if not keep.all():
+			frame = frame[keep].reset_index(drop=True)
+		return gpd.GeoDataFrame(frame, geometry=gpd.GeoSeries(geometry.ToGeometryArray(geometries), index=frame.index), crs='EPSG:4326')
+
+class FeaturePageReader:
+	"""Iterates the pages of a feature query in order while keeping up to prefetch page requests in flight.
+	At most prefetch pages are held in memory, iteration stops at the first short page. """
+
+	def __init__(self, spectrum, service, q, pageLength, prefetch, debug=False, stream=False, cache=None):
+		''' Constructor for this class. With stream each page is parsed incrementally into FeatureColumns instead of a FeatureCollection.
+		A QueryCache serves and stores whole pages, it is not used when streaming. '''
+		self.spectrum=spectrum
+		self.service=service
+		self.query=q
+		self.cache=None if stream else cache
+		self.q=urllib.parse.quote(q)
+		self.pglen=pageLength
+		self.prefetch=prefetch
+		self.debug=debug
+		self.stream=stream
+		self.pages=0
+		self.total=0
+		self.metrics=spectrum.Metrics()
+		self.label=spectrumpy.ServiceName(self.pageUrl(1))
+
+	def pageUrl(self, pageNum):
+		"""Returns the features.json URL of the page. """
+		return self.service + '/tables/features.json?pageLength=' + str(self.pglen) + '&page=' + str(pageNum) + '&q=' + self.q
+
+	def fetch(self, pageNum):
+		"""Fetches one page and returns its FeatureCollection (or FeatureColumns when streaming), None when the request failed. """
+		if self.cache is not None:
+			fc = self.cache.get(self.query, self.pglen, pageNum)
+			if fc is not None:
+				return fc
+		url = self.pageUrl(pageNum)
+		if self.debug:
+			print (url)
+		response = self.spectrum.get(url, stream=self.stream)
+		if response is None:
+			return None
+
+		#
+		# Streamed pages are parsed while they download, so their parse time includes the download.
+		#
+
+		startTime = time.perf_counter()
+		if self.stream:
+			with response:
+				columns = FeatureColumns()
+				for feature in FeatureJSONStream(response.iter_content(chunk_size=65536)):
+					columns.append(feature)
+			self.metrics.Observe(self.label, 'parse', time.perf_counter() - startTime)
+			return columns
+		fc = response.json()
+		self.metrics.Observe(self.label, 'parse', time.perf_counter() - startTime)
+		if fc is None:
+			fc = {'features':[]}
+		if 'features' not in fc:
+			fc['features']=[]
+		if self.cache is not None:
+			self.cache.put(self.query, self.pglen, pageNum, fc)
+		return fc
+
+	def __iter__(self):
+		executor = ThreadPoolExecutor(max_workers=self.prefetch)
+		pending = collections.deque()
+		nextPage = 1
+		try:
+			while len(pending) < self.prefetch:
+				pending.append(executor.submit(self.fetch, nextPage))
+				nextPage += 1
+			while len(pending) > 0:
+				try:
+					fc = pending.popleft().result()
+				except requests.exceptions.RequestException as e:
+					print (e)
+					return
+				if fc is None:
+					return
+				numReturned = len(fc) if self.stream else len(fc['features'])
+				if numReturned > 0:
+					self.pages += 1
+					self.total += numReturned
+					yield fc
+				if numReturned < self.pglen:
+					return
+				pending.append(executor.submit(self.fetch, nextPage))
+				nextPage += 1
+		finally:
+			for future in pending:
+				future.cancel()
+			executor.shutdown(wait=False)
+
+	def collect(self):
+		"""Reads every page and returns a single FeatureCollection. """
+		featureCollection = None
+		for fc in self:
+			if featureCollection is None:
+				featureCollection = fc
+			else:
+				featureCollection['features'].extend(fc['features'])
+		if featureCollection is None:
+			featureCollection = {'type':'FeatureCollection', 'features':[]}
+		return featureCollection
+
+class QueryCache:
+	"""LRU cache of feature query pages keyed by scope, normalized query, page length and page number, with an optional disk tier.
+	Pages are held in memory as marshal bytes, compact and several times faster to load than JSON, so callers can never modify a
+	cached page. On disk they are compressed JSON, so files planted in a shared directory cannot run code or crash the reader. """
+
+	def __init__(self, maxEntries=256, maxBytes=256*1024*1024, ttl=300, directory=None, scope=()):
+		''' Constructor for this class. A directory enables the disk tier, a ttl of None never expires. scope (e.g. server URL and
+		user name) is part of every key, so caches of different servers or users sharing a directory never serve each other's pages. '''
+		self.scope=tuple(scope)
+		self.maxEntries=maxEntries
+		self.maxBytes=maxBytes
+		self.ttl=ttl
+		self.directory=directory
+		self.entries=collections.OrderedDict()
+		self.size=0
+		self.lock=threading.Lock()
+		self.stats={'hits':0, 'diskHits':0, 'misses':0, 'evictions':0, 'invalidations':0}
+		if self.directory is not None:
+			os.makedirs(self.directory, exist_ok=True)
+
+	def normalize(q):
+		"""Returns the cache form of a MapInfo SQL query: white space outside quoted literals and identifiers collapsed and a
+		trailing semicolon removed. """
+		parts = re.split(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")", q)
+		# Odd parts are the quoted strings, their white space is part of the value
+		parts = [part if index % 2 == 1 else re.sub(r'\s+', ' ', part) for index, part in enumerate(parts)]
+		return ''.join(parts).strip().rstrip(';').rstrip()
+
+	def tables(q):
+		"""Returns the lower cased table paths ("/Samples/NamedTables/...") referenced by a query. """
+		return sorted(set([table.lower() for table in re.findall(r'"(/[^"]+)"', q)]))
+
+	def __key(self, q, pageLength, page):
+		return self.scope + (QueryCache.normalize(q), pageLength, page)
+
+	def __path(self, key):
+		return os.path.join(self.directory, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.page')
+
+	def __expired(self, created):
+		return self.ttl is not None and time.time() - created >= self.ttl
+
+	def get(self, q, pageLength, page):
+		"""Returns a fresh copy of the cached page, or None. """
+		key = self.__key(q, pageLength, page)
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None and self.__expired(entry[0]):
+				self.__remove(key)
+				entry = None
+			if entry is not None:
+				self.entries.move_to_end(key)
+				self.stats['hits'] += 1
+				return marshal.loads(entry[2])
+		entry = self.__readDisk(key)
+		with self.lock:
+			if entry is None:
+				self.stats['misses'] += 1
+				return None
+			self.stats['diskHits'] += 1
+			created, tables, fc = entry
+			self.__store(key, (created, tables, marshal.dumps(fc)))
+		return fc
+
+	def put(self, q, pageLength, page, fc):
+		"""Stores a page in both tiers. """
+		key = self.__key(q, pageLength, page)
+		entry = (time.time(), QueryCache.tables(q), marshal.dumps(fc))
+		with self.lock:
+			self.__store(key, entry)
+		self.__writeDisk(key, entry, fc)
+
+	def __store(self, key, entry):
+		if key in self.entries:
+			self.__remove(key)
+		self.entries[key] = entry
+		self.size += len(entry[2])
+
+		#
+		# Evict least recently used pages beyond the entry or byte budget.
+		#
+
+		while len(self.entries) > 1 and (len(self.entries) > self.maxEntries or (self.maxBytes is not None and self.size > self.maxBytes)):
+			oldest = next(iter(self.entries))
+			self.__remove(oldest)
+			self.stats['evictions'] += 1
+
+	def __remove(self, key):
+		entry = self.entries.pop(key)
+		self.size -= len(entry[2])
+
+	def __readDisk(self, key):
+		if self.directory is None:
+			return None
+		path = self.__path(key)
+		try:
+			with open(path, 'rb') as file:
+				header = json.loads(file.readline())
+				if header['key'] != list(key) or self.__expired(header['created']):
+					return None
+				return (header['created'], header['tables'], json.loads(zlib.decompress(file.read())))
+		except (OSError, ValueError, zlib.error, KeyError, TypeError):
+			return None
+
+	def __writeDisk(self, key, entry, fc):
+		if self.directory is None:
+			return
+
+		#
+		# A JSON header line (key, tables, time) precedes the compressed page so invalidation never decompresses pages.
+		#
+
+		fd, tmpPath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as file:
+				file.write(json.dumps({'key':list(key), 'tables':entry[1], 'created':entry[0]}).encode('utf-8') + b'\n')
+				file.write(zlib.compress(json.dumps(fc, separators=(',', ':')).encode('utf-8'), 1))
+			os.replace(tmpPath, self.__path(key))
+		except OSError:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+
+	def invalidate(self, table=None):
+		"""Removes the pages of queries referencing the table path, or every page when no table is given. """
+		table = None if table is None else table.lower()
+		with self.lock:
+			self.stats['invalidations'] += 1
+			for key in list(self.entries):
+				if table is None or table in self.entries[key][1]:
+					self.__remove(key)
+		if self.directory is None:
+			return
+		for name in os.listdir(self.directory):
+			if not name.endswith('.page'):
+				continue
+			path = os.path.join(self.directory, name)
+			try:
+				if table is not None:
+					with open(path, 'rb') as file:
+						if table not in json.loads(file.readline())['tables']:
+							continue
+				os.remove(path)
+			except (OSError, ValueError, KeyError, TypeError):
+				pass
+
+	def statistics(self):
+		"""Returns hit, miss, eviction and size counters. """
+		with self.lock:
+			return dict(self.stats, entries=len(self.entries), bytes=self.size)
+
+class QuantileSketch:
+	"""Mergeable streaming quantile sketch (KLL style compactors). Memory stays around 3k values regardless of the count, and error()
+	returns a probabilistic bound on the rank error of quantile() as a fraction of the count. Sketches of partitions can be merged. """
+
+	def __init__(self, k=200, seed=None):
+		''' Constructor for this class. Larger k is more accurate. '''
+		self.k=k
+		self.levels=[np.empty(0)]
+		self.count=0
+		self.min=math.inf
+		self.max=-math.inf
+		# Sum of the squared weights of all compactions. Each shifts any rank by at most its weight, up or down with equal chance.
+		self.errorVariance=0
+		# Values added one at a time, moved to level 0 in batches
+		self.pending=[]
+		self.rng=np.random.default_rng(seed)
+
+	def __capacity(self, level):
+		return max(2, int(math.ceil(self.k * (2.0 / 3.0) ** (len(self.levels) - level - 1))))
+
+	def __compress(self):
+		compacted = True
+		while compacted:
+			compacted = False
+			for level in range(len(self.levels)):
+				if len(self.levels[level]) <= self.__capacity(level):
+					continue
+
+				#
+				# Sort the level and promote every other value, from a random offset, at twice the weight.
+				#
+
+				if level + 1 == len(self.levels):
+					self.levels.append(np.empty(0))
+				values = np.sort(self.levels[level])
+				keep = values[:len(values) % 2]
+				promoted = values[len(keep) + self.rng.integers(2)::2]
+				self.levels[level] = keep
+				self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+				self.errorVariance += 4 ** level
+				compacted = True
+
+	def __flush(self):
+		if self.pending:
+			pending = self.pending
+			self.pending = []
+			self.__add(np.array(pending, dtype=float))
+
+	def __add(self, values):
+		values = values[~np.isnan(values)]
+		if len(values) == 0:
+			return
+		self.count += len(values)
+		self.min = min(self.min, float(values.min()))
+		self.max = max(self.max, float(values.max()))
+		self.levels[0] = np.concatenate([self.levels[0], values])
+		self.__compress()
+
+	def update(self, value):
+		"""Adds one value, a value that is not numeric is ignored. """
+		try:
+			value = float(value)
+		except (TypeError, ValueError):
+			return self
+		if math.isnan(value):
+			return self
+		self.pending.append(value)
+		if len(self.pending) >= self.k:
+			self.__flush()
+		return self
+
+	def extend(self, values):
+		"""Adds an array or iterable of values, values that are not numeric are ignored. """
+		self.__flush()
+		self.__add(pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=float, na_value=np.nan))
+		return self
+
+	def merge(self, other):
+		"""Adds the values summarized by another sketch to this one. """
+		self.__flush()
+		other.__flush()
+		while len(self.levels) < len(other.levels):
+			self.levels.append(np.empty(0))
+		for level, values in enumerate(other.levels):
+			self.levels[level] = np.concatenate([self.levels[level], values])
+		self.count += other.count
+		self.min = min(self.min, other.min)
+		self.max = max(self.max, other.max)
+		self.errorVariance += other.errorVariance
+		self.__compress()
+		return self
+
+	def error(self, delta=0.01):
+		"""Returns the rank error of quantile() as a fraction of the count that is exceeded with probability at most delta, 0.0 while
+		every value is still held exactly. The bound is probabilistic: compactions promote from a random offset, so their errors are
+		independent, average zero and largely cancel (Hoeffding's inequality). """
+		self.__flush()
+		if self.count == 0:
+			return 0.0
+		return min(1.0, math.sqrt(2 * self.errorVariance * math.log(2 / delta)) / self.count)
+
+	def quantiles(self, qs):
+		"""Returns the approximate values at the quantiles qs (0..1), 0 and 1 return the exact minimum and maximum. """
+		self.__flush()
+		if self.count == 0:
+			return [math.nan for q in qs]
+		values = np.concatenate(self.levels)
+		weights = np.concatenate([np.full(len(level), 2 ** i, dtype=np.int64) for i, level in enumerate(self.levels)])
+		order = np.argsort(values, kind='stable')
+		values = values[order]
+		cumulative = np.cumsum(weights[order])
+		result = []
+		for q in qs:
+			if q <= 0:
+				result.append(self.min)
+			elif q >= 1:
+				result.append(self.max)
+			else:
+				position = min(int(np.searchsorted(cumulative, q * cumulative[-1], side='left')), len(values) - 1)
+				result.append(float(values[position]))
+		return result
+
+	def quantile(self, q):
+		"""Returns the approximate value at the quantile q (0..1). """
+		return self.quantiles([q])[0]
+
+	def __len__(self):
+		return self.count + len(self.pending)
+
 class Geometry:
 	def __init__(self, spatialserver, spectrum):
 		self.spatialserver=spatialserver
 		self.spectrum=spectrum
 	
-	def __coordinateArray2tupleArray(self, coordinates):
-		tuple_array=[]
-		for i in range(len(coordinates)):
-			tuple_array.append((coordinates[i][0],coordinates[i][1]))
-		return tuple_array
-
-	def __arrayOfCoordinateArray2arrayOfTupleArray(self, coordinateArray):
-		arrayOfTupleArray=[]
-		for i in range(len(coordinateArray)):
-			arrayOfTupleArray.append(self.__coordinateArray2tupleArray(coordinateArray[i]))
-		return arrayOfTupleArray
-
-	def __arrayOfArrayOfCoordinateArray2arrayOfArrayOfTupleArray(self, coordinateArray):
-		arrayOfArrayOfTupleArray=[]
-		for i in range(len(coordinateArray)):
-			arrayOfArrayOfTupleArray.append(self.__arrayOfCoordinateArray2arrayOfTupleArray(coordinateArray[i]))
-		return arrayOfArrayOfTupleArray
-
-	def __ToPolygon(self, coordinates):
-		ext=[]
-		ints=[]
-		for i in range(len(coordinates)):
-			if i == 0:
-				ext = self.__coordinateArray2tupleArray(coordinates[i])
-			else:
-				ints.append(self.__coordinateArray2tupleArray(coordinates[i]))
-		return shapely.geometry.Polygon(ext, ints)
-		
-	def __ToMultiPolygon(self, coordinates):
-		polys=[]
-		for i in range(len(coordinates)):
-			polys.append(self.__ToPolygon(coordinates[i]))
-		return shapely.geometry.MultiPolygon(polys)
-
-	def __ToPoint(self, coordinates):
-		shape=shapely.geometry.Point(coordinates[0],coordinates[1])
-		return shape
-
-	def __ToMultiPoint(self, coordinates):
-		return shapely.geometry.MultiPoint(self.__coordinateArray2tupleArray(coordinates))
+	# GeoJSON type => (shapely ragged array type, nesting depth of the coordinate arrays)
+	RAGGED_TYPES = {
+		'Point':('POINT', 0),
+		'LineString':('LINESTRING', 1),
+		'Polygon':('POLYGON', 2),
+		'MultiPoint':('MULTIPOINT', 1),
+		'MultiLineString':('MULTILINESTRING', 2),
+		'MultiPolygon':('MULTIPOLYGON', 3)
+	}
 
-	def __ToLineString(self, coordinates):
-		return shapely.geometry.LineString(self.__coordinateArray2tupleArray(coordinates))
+	def __pack(self, coordinates, depth):
+		"""Packs nested coordinate arrays into a flat coordinate array and one offset array per nesting level. """
+		offsets = []
+		parts = coordinates
+		for level in range(depth):
+			lengths = np.fromiter((len(part) for part in parts), dtype=np.int64, count=len(parts))
+			offsets.insert(0, np.concatenate(([0], np.cumsum(lengths))))
+			parts = list(itertools.chain.from_iterable(parts))
+		if len(parts) == 0:
+			return np.empty((0, 2)), offsets
+		dims = set(map(len, parts))
+		if len(dims) > 1:
+			# Mixed 2D/3D positions, keep x and y
+			parts = [position[:2] for position in parts]
+			dims = {2}
+		dim = dims.pop()
+		coords = np.fromiter(itertools.chain.from_iterable(parts), dtype=float, count=len(parts) * dim).reshape(-1, dim)
+		return coords, offsets
 
-	def __ToMultiCurve(self, coordinates):
-		lines=[]
-		for i in range(len(coordinates)):
-			lines.append(self.__ToLineString(coordinates[i]))
-		return shapely.geometry.MultiLineString(lines)
+	def ToGeometryArray(self, geometries):
+		"""Converts a list of GeoJSON geometry dicts into a numpy array of shapely geometries, one bulk conversion per type. """
+		result = np.empty(len(geometries), dtype=object)
+		groups = {}
+		for i, geometry in enumerate(geometries):
+			if geometry is not None:
+				groups.setdefault(geometry['type'], []).append(i)
+		for gtype, positions in groups.items():
+			if gtype == 'GeometryCollection':
+				members = [geometries[i].get('geometries') or [] for i in positions]
+				parts = self.ToGeometryArray(list(itertools.chain.from_iterable(members)))
+				collections = np.empty(len(members), dtype=object)
+				if len(parts) > 0:
+					lengths = np.fromiter((len(member) for member in members), dtype=np.int64, count=len(members))
+					indices = np.repeat(np.arange(len(members)), lengths)
+					collections = shapely.geometrycollections(parts, indices=indices, out=collections)
+				# Collections without members are left as None by the bulk call, or it was skipped because every one is empty
+				for index in range(len(collections)):
+					if collections[index] is None:
+						collections[index] = shapely.geometrycollections([])
+				result[positions] = collections
+			elif gtype in Geometry.RAGGED_TYPES:
+				raggedType, depth = Geometry.RAGGED_TYPES[gtype]
+				coords, offsets = self.__pack([geometries[i]['coordinates'] for i in positions], depth)
+				if depth == 0:
+					result[positions] = shapely.points(coords)
+				else:
+					result[positions] = shapely.from_ragged_array(shapely.GeometryType[raggedType], coords, tuple(offsets))
+		return result
 
 	def ToGeometry(self, geometry):
 		if geometry is None:
 			return None
 		# TODO: Set the crs
-		
-		gtype = geometry['type']
-		coords = geometry['coordinates']
-		if gtype == 'MultiPolygon':
-			return self.__ToMultiPolygon(coords)
-		elif gtype == 'Point':
-			return self.__ToPoint(coords)
-		elif gtype == 'MultiPoint':
-			return self.__ToMultiPoint(coords)
-		elif gtype == 'MultiLineString':
-			return self.__ToMultiCurve(coords)
-	#     elif gtype == 'Collection': TODO
+		return self.ToGeometryArray([geometry])[0]
 
 	def GeoJSON2GeoDataFrame(self, fc):
-		hasGeometry=False
-		column_list=[]
-		data_list=[]
-		if fc['features'] is not None:
-			if len(fc['features']) > 0:
-				for propset in fc['features'][0]['properties']:
-					column_list.append(propset)
-				if fc['features'][0]['geometry'] is not None:
-					column_list.append('geometry')
-					hasGeometry=True
-			for feature in fc['features']:
-				record=[]
-				for prop in feature['properties']:
-					record.append(feature['properties'][prop])
-				if feature['geometry'] is not None:
-					record.append(self.ToGeometry(feature['geometry']))
-				if not hasGeometry or feature['geometry'] is not None: 
-					data_list.append(record)
+		"""Converts a FeatureCollection into a GeoDataFrame, or a DataFrame when the features have no geometry. """
+		features = fc['features'] if fc['features'] is not None else []
+		if len(features) == 0:
+			return pd.DataFrame([], columns=[])
+
+		#
+		# Build attribute columns straight from the property dicts, columns follow the first feature.
+		#
+
+		hasGeometry = features[0]['geometry'] is not None
+		if hasGeometry:
+			features = [feature for feature in features if feature['geometry'] is not None]
+		column_list = list(features[0]['properties'])
+		frame = pd.DataFrame([feature['properties'] for feature in features], columns=column_list)
 		if not hasGeometry:
-			gdf=pd.DataFrame(data_list,columns=column_list)
-		else:
-			gdf=gpd.GeoDataFrame(data_list,columns=column_list,crs={'init': 'epsg:4326'})
-		return gdf
+			return frame
+
+		geometry = self.ToGeometryArray([feature['geometry'] for feature in features])
+		return gpd.GeoDataFrame(frame, geometry=gpd.GeoSeries(geometry, index=frame.index), crs='EPSG:4326')
 
 class Thematics:
 	def __init__(self, spatialserver, spectrum):
@@ -336,150 +1189,183 @@ class Thematics:
 	def generate_range_theme_buckets(self, data_series, n_bins, start_color, end_color):
 		quantiles = pd.qcut(data_series, n_bins, retbins=True)
 		bins=quantiles[1]
+		return Thematics.__range_buckets(bins, n_bins, start_color, end_color)
+
+	def __range_buckets(bins, n_bins, start_color, end_color):
 		colors = list(colour.Color(start_color).range_to(colour.Color(end_color),n_bins))
 		colors.append(colour.Color(end_color))
 		range_buckets = list(zip(bins, colors))
 		return range_buckets
+
+	def sketch_theme_values(self, source, theme_property, k=200, sketch=None):
+		"""Summarizes the theme_property values of source into a QuantileSketch one page at a time. source is a FeatureCollection, a
+		(Geo)DataFrame, or an iterable of pages, features or DataFrame chunks, e.g. FeatureService.query(q, pageLength=n) or query_frames(q). """
+		if sketch is None:
+			sketch = QuantileSketch(k)
+		if isinstance(source, pd.DataFrame) or (isinstance(source, dict) and 'features' in source):
+			source = [source]
+		features = []
+		for item in source:
+			if isinstance(item, pd.DataFrame):
+				sketch.extend(item[theme_property].to_numpy())
+			elif 'features' in item:
+				sketch.extend([feature['properties'].get(theme_property) for feature in item['features']])
+			else:
+				features.append(item['properties'].get(theme_property))
+				if len(features) >= 10000:
+					sketch.extend(features)
+					features = []
+		sketch.extend(features)
+		return sketch
+
+	def generate_streaming_range_theme_buckets(self, source, theme_property, n_bins, start_color, end_color, k=200):
+		"""Like generate_range_theme_buckets, but the breakpoints come from a QuantileSketch so the values are never all in memory.
+		source is a QuantileSketch (e.g. merged from parallel workers) or anything sketch_theme_values accepts. Each breakpoint is
+		within sketch.error() of its exact rank with 99% probability. """
+		sketch = source if isinstance(source, QuantileSketch) else self.sketch_theme_values(source, theme_property, k)
+		bins = sketch.quantiles(np.linspace(0, 1, n_bins + 1))
+		return Thematics.__range_buckets(bins, n_bins, start_color, end_color)
 	
+	def aggregate_theme_values(self, table, theme_property, function='Count', column='*', where=None):
+		"""Returns function(column) per theme_property value, computed on the server without transferring geometry. The Series
+		feeds generate_range_theme_buckets as data_series and convert_to_indiv_value as lookup_table. """
+		alias = function.lower() + '_' + ('all' if column == '*' else re.sub(r'\W', '_', column))
+		return self.spatialserver.FeatureService().aggregate(table, theme_property, {alias:(function, column)}, where)
+
 	def convert_to_indiv_value(self, data, theme_property, ranges, lookup_table, stroke_color, stroke_weight, fill_opacity, all_others_fill_color):
-		indiv_value_theme_buckets = []
-		for feature in data['features']:
-			tp = feature['properties'][theme_property]
-			fill = all_others_fill_color
-			for x in lookup_table.axes[0]:
-				if tp == x:
-					rv = lookup_table[x]
-					for bucket, color in ranges:
-						if rv >= bucket:
-							fill = color.get_hex()
-			row=[tp, {'color':stroke_color, 'weight': stroke_weight, 'fillColor':fill, 'fillOpacity':fill_opacity}]
-			indiv_value_theme_buckets.append(row)
-		return indiv_value_theme_buckets
+		"""Returns a [value, style] pair per feature. The value is joined to lookup_table and styled with the last range bucket it reaches,
+		or all_others_fill_color. data is a FeatureCollection, a (Geo)DataFrame with a theme_property column or a Series of values.
+		Rows with the same fill share one style dict. """
+		values = Thematics.__theme_values(data, theme_property)
+
+		#
+		# Hash join the feature values to the lookup values, then find each value's bucket by binary search.
+		#
+
+		lookup = lookup_table[~lookup_table.index.duplicated(keep='last')]
+		rv = pd.Series(values, dtype=object).map(lookup).to_numpy(dtype=float, na_value=np.nan)
+		bins = np.array([bucket for bucket, color in ranges], dtype=float)
+		fills = np.array([color.get_hex() for bucket, color in ranges] + [all_others_fill_color], dtype=object)
+		if np.all(bins[1:] >= bins[:-1]):
+			positions = np.searchsorted(bins, rv, side='right') - 1
+		else:
+			positions = np.full(len(rv), -1)
+			for i, bucket in enumerate(bins):
+				positions[rv >= bucket] = i
+		positions[(positions < 0) | np.isnan(rv)] = len(bins)
+
+		#
+		# Rows with the same fill share one style dict.
+		#
+
+		styles = np.array([{'color':stroke_color, 'weight': stroke_weight, 'fillColor':fill, 'fillOpacity':fill_opacity} for fill in fills], dtype=object)
+		return [[tp, style] for tp, style in zip(values, styles[positions].tolist())]
+
+	def __theme_values(data, theme_property):
+		if isinstance(data, pd.Series):
+			return data.tolist()
+		if isinstance(data, pd.DataFrame):
+			return data[theme_property].tolist()
+		return [feature['properties'][theme_property] for feature in data['features']]
 	
+	def indiv_value_style_index(self, indiv_value_theme_buckets):
+		"""Returns a value => style dict of the [value, style] buckets, the last bucket of a value wins. Equal styles become one shared dict. """
+		if isinstance(indiv_value_theme_buckets, dict):
+			return indiv_value_theme_buckets
+		index = {}
+		styles = {}
+		for value, style in indiv_value_theme_buckets:
+			try:
+				key = tuple(sorted(style.items()))
+				style = styles.setdefault(key, style)
+			except TypeError:
+				pass
+			index[value] = style
+		return index
+
 	def apply_indiv_value_theme(self, data, theme_property, indiv_value_theme_buckets):
-		for feature in data['features']:
-			tp = feature['properties'][theme_property]
-			for x in indiv_value_theme_buckets:
-				if tp == x[0]:
-					feature['properties']['style'] = x[1]
+		"""Sets the 'style' property of every feature whose theme_property value has a bucket, in place. The buckets may be a prebuilt
+		indiv_value_style_index. Features share their style dicts. """
+		index = self.indiv_value_style_index(indiv_value_theme_buckets)
+		Thematics.__style_features(data['features'], theme_property, index)
+
+	def stream_indiv_value_theme(self, source, theme_property, indiv_value_theme_buckets):
+		"""Styles features lazily as they are read. source is an iterable of features, e.g. FeatureService.features(q), or of FeatureCollection
+		pages, e.g. FeatureService.query(q, pageLength=n). Each item is styled in place and yielded. """
+		index = self.indiv_value_style_index(indiv_value_theme_buckets)
+		for item in source:
+			if 'features' in item:
+				Thematics.__style_features(item['features'], theme_property, index)
+			else:
+				Thematics.__style_features((item,), theme_property, index)
+			yield item
+
+	def __style_features(features, theme_property, index):
+		for feature in features:
+			properties = feature['properties']
+			try:
+				properties['style'] = index[properties[theme_property]]
+			except (KeyError, TypeError):
+				pass
 					
 
 #TODO: How to document functions and arguments
 
 	def write_map(self, map_path, map_name, layers, center, zoom=10000, zoomUnit="mi"):
-		sz=''
-		sz=sz+'<mxp:NamedMapDefinition version="MXP_NamedResource_1_5" xmlns:mxp="http://www.mapinfo.com/mxp" xmlns:gml="http://www.opengis.net/gml">'
-		sz=sz+'    <mxp:ConnectionSet/>'
-		sz=sz+'    <mxp:DataSourceDefinitionSet/>'
-		sz=sz+'    <mxp:MapDefinition id="id1" name="name1" alias="alias1" uniqueId="' + map_name + '">'
-		sz=sz+'        <mxp:DisplayConditions>'
-		sz=sz+'            <mxp:MapSize uom="mapinfo:imagesize pixel">'
-		sz=sz+'                <mxp:ImageWidth>768</mxp:ImageWidth>'
-		sz=sz+'                <mxp:ImageHeight>1024</mxp:ImageHeight>'
-		sz=sz+'            </mxp:MapSize>'
-		sz=sz+'            <mxp:ZoomAndCenter>'
-		sz=sz+'                <mxp:MapZoom uom="mapinfo:length '+zoomUnit+'">'+str(zoom)+'</mxp:MapZoom>'
-		sz=sz+'                <gml:Point srsName="EPSG:4326">'
-		sz=sz+'                    <gml:coordinates>'+str(center[1])+','+str(center[0])+'</gml:coordinates>'
-		sz=sz+'                </gml:Point>'
-		sz=sz+'            </mxp:ZoomAndCenter>'
-		sz=sz+'            <mxp:DisplayCoordSys>'
-		sz=sz+'                <mxp:SRSName>EPSG:4326</mxp:SRSName>'
-		sz=sz+'            </mxp:DisplayCoordSys>'
-		sz=sz+'            <mxp:MapBackground>'
-		sz=sz+'                <mxp:AreaStyle/>'
-		sz=sz+'            </mxp:MapBackground>'
-		sz=sz+'        </mxp:DisplayConditions>'
-		sz=sz+'        <mxp:LayerList>'
+		self.spatialserver.NamedResourceService().upsert(map_path,map_name,self.map_document(map_name, layers, center, zoom, zoomUnit))
+
+	def map_document(self, map_name, layers, center, zoom=10000, zoomUnit="mi"):
+		"""Returns the MXP NamedMapDefinition written by write_map as an lxml element. """
+		root = Mxp.document('NamedMapDefinition')
+		Mxp.element(root, 'ConnectionSet')
+		Mxp.element(root, 'DataSourceDefinitionSet')
+		definition = Mxp.element(root, 'MapDefinition', {'id':'id1', 'name':'name1', 'alias':'alias1', 'uniqueId':map_name})
+		conditions = Mxp.element(definition, 'DisplayConditions')
+		size = Mxp.element(conditions, 'MapSize', {'uom':'mapinfo:imagesize pixel'})
+		Mxp.element(size, 'ImageWidth', text='768')
+		Mxp.element(size, 'ImageHeight', text='1024')
+		zoomAndCenter = Mxp.element(conditions, 'ZoomAndCenter')
+		Mxp.element(zoomAndCenter, 'MapZoom', {'uom':'mapinfo:length ' + zoomUnit}, str(zoom))
+		point = Mxp.element(zoomAndCenter, 'Point', {'srsName':'EPSG:4326'}, namespace=Mxp.GML_NAMESPACE)
+		Mxp.element(point, 'coordinates', text=str(center[1]) + ',' + str(center[0]), namespace=Mxp.GML_NAMESPACE)
+		Mxp.element(Mxp.element(conditions, 'DisplayCoordSys'), 'SRSName', text='EPSG:4326')
+		Mxp.element(Mxp.element(conditions, 'MapBackground'), 'AreaStyle')
+		layerList = Mxp.element(definition, 'LayerList')
 		for layerRef in layers:
 			layer_path = layerRef[0]
 			layer_name = layerRef[1]
-			sz=sz+'            <mxp:NamedLayerRef name="'+layer_name+'" resourceID="'+layer_path+'/'+layer_name+'"/>'
-		sz=sz+'        </mxp:LayerList>'
-		sz=sz+'    </mxp:MapDefinition>'
-		sz=sz+'</mxp:NamedMapDefinition>'
-		self.spatialserver.NamedResourceService().upsert(map_path,map_name,sz)
+			Mxp.element(layerList, 'NamedLayerRef', {'name':layer_name, 'resourceID':layer_path + '/' + layer_name})
+		return root
 
 	def write_indiv_value_theme(self, path, layer_name, table_name, theme_property, value_map):
+		self.spatialserver.NamedResourceService().upsert(path,layer_name,self.indiv_value_theme_document(layer_name, table_name, theme_property, value_map))
+
+	def indiv_value_theme_document(self, layer_name, table_name, theme_property, value_map):
+		"""Returns the MXP NamedLayer written by write_indiv_value_theme as an lxml element, with one bin per [value, style] pair. """
 		isNumeric=True
 		for val_set in value_map:
 			if type(val_set[0]) != int and type(val_set[0]) != float:
 				isNumeric=False
-		sz=''
-		sz=sz+'<mxp:NamedLayer version="MXP_NamedResource_1_5" xmlns:mxp="http://www.mapinfo.com/mxp" xmlns:gml="http://www.opengis.net/gml">'
-		sz=sz+'    <mxp:ConnectionSet/>'
-		sz=sz+'    <mxp:DataSourceDefinitionSet>'
-		sz=sz+'        <mxp:NamedDataSourceDefinitionRef id="id1" resourceID="'+table_name+'"/>'
-		sz=sz+'    </mxp:DataSourceDefinitionSet>'
-		sz=sz+'    <mxp:FeatureLayer id="id2" name="'+layer_name+'" alias="'+layer_name+'" namedLabelSourceRef="'+table_name+'">'
-		sz=sz+'        <mxp:DataSourceRef ref="id1"/>'
-		sz=sz+'        <mxp:FeatureStyleModifierThemeList>'
-		sz=sz+'            <mxp:FeatureStyleIndividualValueTheme id="id3" name="IndividualValueTheme" alias="id_1">'
-		sz=sz+'                <mxp:IndividualValueExpression>'
+		root = Mxp.document('NamedLayer')
+		Mxp.element(root, 'ConnectionSet')
+		Mxp.element(Mxp.element(root, 'DataSourceDefinitionSet'), 'NamedDataSourceDefinitionRef', {'id':'id1', 'resourceID':table_name})
+		layer = Mxp.element(root, 'FeatureLayer', {'id':'id2', 'name':layer_name, 'alias':layer_name, 'namedLabelSourceRef':table_name})
+		Mxp.element(layer, 'DataSourceRef', {'ref':'id1'})
+		theme = Mxp.element(Mxp.element(layer, 'FeatureStyleModifierThemeList'), 'FeatureStyleIndividualValueTheme', {'id':'id3', 'name':'IndividualValueTheme', 'alias':'id_1'})
+		expression = Mxp.element(theme, 'IndividualValueExpression')
 		if isNumeric:
-			sz=sz+'                    <mxp:NumericValueExpression>'
-			sz=sz+'                        <mxp:MapinfoNumericExpression>' + theme_property + '</mxp:MapinfoNumericExpression>'
-			sz=sz+'                    </mxp:NumericValueExpression>'
+			Mxp.element(Mxp.element(expression, 'NumericValueExpression'), 'MapinfoNumericExpression', text=theme_property)
 		else:
-			sz=sz+'                    <mxp:StringValueExpression>'
-			sz=sz+'                        <mxp:MapinfoStringExpression>' + theme_property + '</mxp:MapinfoStringExpression>'
-			sz=sz+'                    </mxp:StringValueExpression>'
-		sz=sz+'                </mxp:IndividualValueExpression>'
-		sz=sz+'                <mxp:IndividualValueBaseStyle applyStylePart="all"/>'
-		sz=sz+'                <mxp:IndividualValueBinSet>'
+			Mxp.element(Mxp.element(expression, 'StringValueExpression'), 'MapinfoStringExpression', text=theme_property)
+		Mxp.element(theme, 'IndividualValueBaseStyle', {'applyStylePart':'all'})
+		bins = Mxp.element(theme, 'IndividualValueBinSet')
 		for val_set in value_map:
-			sz=sz+'                    <mxp:IndividualValueBin>'
-			if isNumeric:
-				sz=sz+'                        <mxp:NumericValue>'+str(val_set[0])+'</mxp:NumericValue>'
-			else:
-				sz=sz+'                        <mxp:StringValue>'+str(val_set[0])+'</mxp:StringValue>'
-			sz=sz+'                        <mxp:CompositeStyle>'
-			sz=sz+'                            <mxp:AreaStyle>'
-			sz=sz+'                                <mxp:LineStyle stroke="'+val_set[1]["color"]+'" width="'+str(val_set[1]["weight"])+'" width-unit="mapinfo:imagesize pixel">'
-			sz=sz+'                                    <mxp:Pen>mapinfo:Pen 2</mxp:Pen>'
-			sz=sz+'                                </mxp:LineStyle>'
-			sz=sz+'                                <mxp:Interior fill="(#id1)" fill-opacity="'+str(val_set[1]["fillOpacity"])+'">'
-			sz=sz+'                                    <mxp:Defs>'
-			sz=sz+'                                        <mxp:Pattern id="id1">'
-			sz=sz+'                                            <mxp:Bitmap uri="mapinfo:brush 2">'
-			sz=sz+'                                                <mxp:ColorAdjustmentSet>'
-			sz=sz+'                                                    <mxp:ColorAdjustment color-1="nonWhite" color-2="'+val_set[1]["fillColor"]+'"/>'
-			sz=sz+'                                                    <mxp:ColorAdjustment color-1="white" color-2="'+val_set[1]["fillColor"]+'"/>'
-			sz=sz+'                                                </mxp:ColorAdjustmentSet>'
-			sz=sz+'                                            </mxp:Bitmap>'
-			sz=sz+'                                        </mxp:Pattern>'
-			sz=sz+'                                    </mxp:Defs>'
-			sz=sz+'                                </mxp:Interior>'
-			sz=sz+'                            </mxp:AreaStyle>'
-			sz=sz+'                        </mxp:CompositeStyle>'
-			sz=sz+'                    </mxp:IndividualValueBin>'
-		sz=sz+'                    <mxp:AllOthersStyle>'
-		sz=sz+'                        <mxp:CompositeStyle>'
-		sz=sz+'                            <mxp:AreaStyle>'
-		sz=sz+'                                <mxp:LineStyle stroke="black" width="1.0" width-unit="mapinfo:imagesize pixel">'
-		sz=sz+'                                    <mxp:Pen>mapinfo:Pen 2</mxp:Pen>'
-		sz=sz+'                                </mxp:LineStyle>'
-		sz=sz+'                                <mxp:Interior fill="(#id1)" fill-opacity="0.0">'
-		sz=sz+'                                    <mxp:Defs>'
-		sz=sz+'                                        <mxp:Pattern id="id1">'
-		sz=sz+'                                            <mxp:Bitmap uri="mapinfo:brush 1">'
-		sz=sz+'                                                <mxp:ColorAdjustmentSet>'
-		sz=sz+'                                                    <mxp:ColorAdjustment color-1="black" color-2="black"/>'
-		sz=sz+'                                                    <mxp:ColorAdjustment color-1="white" color-2="white"/>'
-		sz=sz+'                                                </mxp:ColorAdjustmentSet>'
-		sz=sz+'                                            </mxp:Bitmap>'
-		sz=sz+'                                        </mxp:Pattern>'
-		sz=sz+'                                    </mxp:Defs>'
-		sz=sz+'                                </mxp:Interior>'
-		sz=sz+'                            </mxp:AreaStyle>'
-		sz=sz+'                        </mxp:CompositeStyle>'
-		sz=sz+'                        <mxp:LegendRowOverride visible="false">'
-		sz=sz+'                            <mxp:Text/>'
-		sz=sz+'                        </mxp:LegendRowOverride>'
-		sz=sz+'                    </mxp:AllOthersStyle>'
-		sz=sz+'                </mxp:IndividualValueBinSet>'
-		sz=sz+'            </mxp:FeatureStyleIndividualValueTheme>'
-		sz=sz+'        </mxp:FeatureStyleModifierThemeList>'
-		sz=sz+'    </mxp:FeatureLayer>'
-		sz=sz+'</mxp:NamedLayer>'
-		self.spatialserver.NamedResourceService().upsert(path,layer_name,sz)
+			style = val_set[1]
+			valueBin = Mxp.element(bins, 'IndividualValueBin')
+			Mxp.element(valueBin, 'NumericValue' if isNumeric else 'StringValue', text=str(val_set[0]))
+			Mxp.area_style(valueBin, style["color"], style["weight"], 'mapinfo:Pen 2', style["fillOpacity"], 'mapinfo:brush 2',
+				[('nonWhite', style["fillColor"]), ('white', style["fillColor"])])
+		allOthers = Mxp.element(bins, 'AllOthersStyle')
+		Mxp.area_style(allOthers, 'black', '1.0', 'mapinfo:Pen 2', '0.0', 'mapinfo:brush 1', [('black', 'black'), ('white', 'white')])
+		Mxp.element(Mxp.element(allOthers, 'LegendRowOverride', {'visible':'false'}), 'Text')
+		return root
@@ -0,0 +1,27 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import json
+import pytest
+from spectrumspatialpy.spectrumspatialpy import FeatureJSONStream
+
+# Numbers whose prefixes are valid numbers too, so a chunk boundary inside them must not end the value
+FIXTURE = (b'{"totalCount":1e5,"skew":-0.0005,"features":[{"type":"Feature","properties":{"a":-0.0005,"b":1e5,"c":12345678,'
+	b'"d":-1.5E-7,"e":0,"f":true,"g":null},"geometry":{"type":"Point","coordinates":[-73.25,40.5e1]}},{"properties":{"a":2E+3}}],"x":3.25}')
+
+@pytest.mark.parametrize('size', range(1, 9))
+def test_numbers_split_across_chunks(size):
+	expected = json.loads(FIXTURE)
+	stream = FeatureJSONStream(FIXTURE[i:i+size] for i in range(0, len(FIXTURE), size))
+	assert list(stream) == expected.pop('features')
+	assert stream.header == expected
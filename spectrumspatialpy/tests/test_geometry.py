@@ -0,0 +1,29 @@
+#
+# Copyright 2019 Pitney Bowes Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#	http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+#
+#
+import spectrumspatialpy
+
+EMPTY = {'type':'GeometryCollection', 'geometries':[]}
+POINT = {'type':'Point', 'coordinates':[1, 2]}
+
+def to_wkt(geometries):
+	return [geometry.wkt for geometry in spectrumspatialpy.Geometry(None, None).ToGeometryArray(geometries)]
+
+def test_all_empty_collections():
+	assert to_wkt([EMPTY]) == ['GEOMETRYCOLLECTION EMPTY']
+	assert to_wkt([EMPTY, EMPTY]) == ['GEOMETRYCOLLECTION EMPTY', 'GEOMETRYCOLLECTION EMPTY']
+
+def test_empty_collection_next_to_other_geometries():
+	assert to_wkt([EMPTY, POINT]) == ['GEOMETRYCOLLECTION EMPTY', 'POINT (1 2)']
+	collection = {'type':'GeometryCollection', 'geometries':[POINT]}
+	assert to_wkt([collection, EMPTY, collection]) == ['GEOMETRYCOLLECTION (POINT (1 2))', 'GEOMETRYCOLLECTION EMPTY', 'GEOMETRYCOLLECTION (POINT (1 2))']